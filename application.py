@@ -79,5 +79,13 @@ if __name__ == '__main__':
     app.session_interface.session_store = FilesystemSessionStore(
         '/tmp', session_class=Session
     )
-    http_server = WSGIServer(('127.0.0.1', 5000), app)
+    try:
+        from geventwebsocket.handler import WebSocketHandler
+    except ImportError:
+        # The websocket of the chat is not available
+        http_server = WSGIServer(('127.0.0.1', 5000), app)
+    else:
+        http_server = WSGIServer(
+            ('127.0.0.1', 5000), app, handler_class=WebSocketHandler
+        )
     http_server.serve_forever()
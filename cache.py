@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    Caches of the data read on the hot paths of the chat, like the members
+    of the threads.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import simplejson as json
+from trytond.config import CONFIG
+
+from hub import RedisMixin
+
+__all__ = [
+    'LRUCache', 'RedisCache', 'get_cache', 'get_thread_cache',
+    'get_user_cache', 'get_room_cache', 'get_token_cache',
+]
+
+
+class LRUCache(object):
+    '''
+    A cache in the memory of the process which keeps the size most
+    recently used entries, each for ttl seconds at most.
+
+    :param size: Maximum number of entries.
+    :param ttl: Seconds an entry is valid for, None to keep them until they
+                are evicted or deleted.
+    '''
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        '''
+        Returns the value of the key, None if not in the cache or expired.
+        '''
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            # Move the entry to the end, as the most recently used
+            self.entries[key] = (expires, value)
+            return value
+
+    def get_many(self, keys):
+        '''
+        Returns the values of the keys, None for those not in the cache.
+        '''
+        return map(self.get, keys)
+
+    def set(self, key, value):
+        '''
+        Sets the value of the key, evicting the least recently used entry if
+        the cache is full.
+        '''
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        '''
+        Removes the keys from the cache.
+        '''
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        '''
+        Removes all the entries.
+        '''
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisCache(RedisMixin):
+    '''
+    A cache shared by all the processes through redis. The values are kept
+    as JSON under the namespace, for ttl seconds.
+
+    :param namespace: The part of the redis keys naming the cache.
+    :param ttl: Seconds an entry is valid for.
+    '''
+
+    def __init__(self, namespace, ttl=300, prefix='chat'):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_key(self, key):
+        '''
+        Returns the redis key of the key of the cache
+        '''
+        return '%s:%s:%s' % (self.prefix, self.namespace, key)
+
+    def get(self, key):
+        value = self.redis.get(self.get_key(key))
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [
+            json.loads(value) if value is not None else None
+            for value in self.redis.mget(map(self.get_key, keys))
+        ]
+
+    def set(self, key, value):
+        self.redis.set(self.get_key(key), json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.redis.delete(*map(self.get_key, keys))
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(self.get_key('*')))
+        if keys:
+            self.redis.delete(*keys)
+
+
+def get_cache(name, size=10000, ttl=300):
+    '''
+    Returns the cache of the name with the backend set by the
+    `chat_<name>_cache` option of the tryton config, `local` or `redis`,
+    and the size and ttl set by the `chat_<name>_cache_size` and
+    `chat_<name>_cache_ttl` options.
+
+    The backend defaults to `redis` with the `redis` hub, as the site is
+    then served by several processes which must all see an entry dropped,
+    and to `local` else.
+    '''
+    ttl = int(CONFIG.get('chat_%s_cache_ttl' % name, ttl))
+    default = 'redis' if CONFIG.get('chat_hub') == 'redis' else 'local'
+    if CONFIG.get('chat_%s_cache' % name, default) == 'redis':
+        return RedisCache('%ss' % name, ttl=ttl)
+    return LRUCache(
+        size=int(CONFIG.get('chat_%s_cache_size' % name, size)), ttl=ttl
+    )
+
+
+def get_thread_cache():
+    '''
+    Returns the cache of the members of the threads
+    '''
+    return get_cache('thread')
+
+
+def get_user_cache():
+    '''
+    Returns the cache of the serialized users
+    '''
+    return get_cache('user')
+
+
+def get_room_cache():
+    '''
+    Returns the cache of the rooms of the users
+    '''
+    return get_cache('room')
+
+
+def get_token_cache():
+    '''
+    Returns the cache of the chat tokens already validated, kept in the
+    process for `chat_token_cache_ttl` seconds (default 30) so that the
+    reconnects of a stream do not all go to redis.
+    '''
+    return LRUCache(
+        size=int(CONFIG.get('chat_token_cache_size', 10000)),
+        ttl=int(CONFIG.get('chat_token_cache_ttl', 30)),
+    )
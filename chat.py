@@ -5,20 +5,31 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import time
 import uuid
 
-from gevent import queue
-from redis import Redis
 import simplejson as json
+import gevent
+from gevent import queue
 from flask_wtf import Form
 from wtforms import IntegerField, validators
 from nereid import request, render_template, jsonify, Response, abort, \
-    login_required, route, current_app, current_user
+    login_required, route, current_user
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.transaction import Transaction
-from trytond.config import CONFIG
 from trytond.pool import Pool, PoolMeta
+from trytond import backend
+from trytond.config import CONFIG
+
+from hub import Stanza, batch_frame, get_message_queue, get_redis_client
+from store import get_message_store
+from cache import get_thread_cache, get_user_cache, get_room_cache, \
+    get_token_cache
+from metrics import REGISTRY, PRESENCE_FANOUT, PRESENCE_SUPPRESSED, \
+    SEND_MESSAGE_SECONDS, SAVE_MESSAGE_SECONDS, STREAMS_OPENED, Trace, timed
 
 __all__ = ['NereidUser', 'NereidChat', 'ChatMember', 'Message']
 __metaclass__ = PoolMeta
@@ -31,72 +42,84 @@ class NewChatForm(Form):
     user = IntegerField('User', [validators.Required()])
 
 
-class MessageQueue(object):
-    '''
-    A simple message queue system that will allow this POC to run
-    '''
-
-    def __init__(self):
-        self.store = {}
-
-    def get_queue(self, user):
-        '''
-        Return the queue of the user
-        '''
-        # Tryton has one python instance for several databases. So namespace
-        # the store for each database
-        return self.store.setdefault(
-            Transaction().cursor.dbname, {}
-        ).setdefault(user, queue.Queue())
-
-    def is_user_offline(self, user, threshold=5):
-        '''
-        Assumes that a user_backlog more than the threshold means the user is
-        offline
-
-        :param user: Id of user.
-        :param threshold: Maximum Limit of queue.
-
-        :return: True/False if user is offline.
-        '''
-        return self.user_backlog(user) > threshold
-
-    def user_backlog(self, user):
-        '''
-        Returns the number of messages waiting for a user to be received
-        '''
-        return self.get_queue(user).qsize()
-
-    def publish(self, user, data):
-        '''
-        Push the data to the queue of the user.
+MQ = get_message_queue()
+REGISTRY.add_collector(MQ.get_metrics)
+MESSAGE_STORE = get_message_store()
+THREAD_CACHE = get_thread_cache()
+USER_CACHE = get_user_cache()
+ROOM_CACHE = get_room_cache()
+TOKEN_CACHE = get_token_cache()
+#: Give the cursor of the request back to the database while streaming
+DETACH_STREAMS = CONFIG.get('chat_detach_streams', True)
+#: The number of members from which a thread is a room
+ROOM_SIZE = int(CONFIG.get('chat_room_size', 3))
 
-        :param user: Id of user.
-        :param data: Data to publish on queue.
-        '''
-        return self.get_queue(user).put(data)
 
-    def listen(self, user, dbname=None):
-        '''
-        Listen to messages of the user and yield whenever something is there
+@contextmanager
+def stream_cursor(dbname):
+    '''
+    Serve a stream within the block. If the streams are detached, the work
+    of the request is committed and its cursor given back to the database
+    for the time of the stream, and the transaction gets a new cursor
+    afterwards for whoever closes it. Else the stream is counted in the
+    `cursors` usage of the hub while it holds the cursor.
+
+    Committing is a side effect on the transaction of the caller, which
+    cannot roll back what it did before the stream, so the views of the
+    streams do nothing else. The event streams run once nereid has
+    committed and closed the cursor of the request, so they hold none
+    either way and are never counted; only the websockets are.
+
+    :param dbname: Name of the database of the stream.
+    '''
+    transaction = Transaction()
+    cursor = transaction.cursor
+    if cursor is None:
+        yield
+    elif DETACH_STREAMS:
+        cursor.commit()
+        cursor.close()
+        transaction.cursor = None
+        try:
+            yield
+        finally:
+            Database = backend.get('Database')
+            transaction.cursor = Database(dbname).connect().cursor()
+    else:
+        usage = MQ.get_usage(dbname)
+        usage['cursors'] += 1
+        try:
+            yield
+        finally:
+            usage['cursors'] -= 1
 
-        :param user: Id of user.
-        :param dbname: Optionally specify the dbname, if the transaction
-                       context is not available
-        '''
-        if dbname is not None:
-            q = self.store.setdefault(
-                dbname, {}).setdefault(user, queue.Queue())
-        else:
-            q = self.get_queue(user)
 
-        while True:
-            try:
-                yield q.get(timeout=5)
-            except queue.Empty:
-                yield '{}'
+@contextmanager
+def stanza_cursor(dbname):
+    '''
+    Do the work of a stanza received by a stream within the block. A
+    detached stream takes a cursor for the block, which is committed and
+    given back at the end. Else the cursor held by the stream is committed.
 
-MQ = MessageQueue()
+    :param dbname: Name of the database of the stream.
+    '''
+    transaction = Transaction()
+    if transaction.cursor is not None:
+        yield
+        transaction.cursor.commit()
+        return
+
+    Database = backend.get('Database')
+    usage = MQ.get_usage(dbname)
+    cursor = Database(dbname).connect().cursor()
+    usage['cursors'] += 1
+    try:
+        with transaction.set_cursor(cursor):
+            yield
+            cursor.commit()
+    finally:
+        cursor.close()
+        usage['cursors'] -= 1
 
 
 class NereidUser(ModelSQL, ModelView):
@@ -109,12 +132,14 @@ class NereidUser(ModelSQL, ModelView):
         fields.Boolean('Available'), 'get_available'
     )
 
-    def get_available(self, name):
+    @classmethod
+    def get_available(cls, users, name):
         '''
-        Looks into the message queue and figures out if the user is available
-        or not
+        Looks into the connections registry of the message queue and
+        figures out which of the users are available
         '''
-        return not MQ.is_user_offline(self)
+        online = MQ.filter_online([user.id for user in users])
+        return dict((user.id, user.id in online) for user in users)
 
     def serialize(self, purpose=None):
         """
@@ -129,6 +154,58 @@ class NereidUser(ModelSQL, ModelView):
             "displayName": self.display_name,
         }
 
+    @staticmethod
+    def get_user_key(user_id):
+        """
+        Returns the key of the user in the user cache
+        """
+        return '%s:%s' % (Transaction().cursor.dbname, user_id)
+
+    @classmethod
+    def get_serialized(cls, users):
+        """
+        Returns the serialized form of the users, in the same order. The
+        users are serialized once and kept in the user cache, and the
+        users which are not cached yet are read at once.
+
+        :param users: List of ids or browse records of nereid_user.
+        """
+        ids = map(int, users)
+        keys = map(cls.get_user_key, ids)
+        serialized = USER_CACHE.get_many(keys)
+        missing = [id for id, value in zip(ids, serialized) if value is None]
+        if missing:
+            for user in cls.browse(list(set(missing))):
+                value = user.serialize()
+                USER_CACHE.set(cls.get_user_key(user.id), value)
+                for index, id in enumerate(ids):
+                    if id == user.id:
+                        serialized[index] = value
+        return serialized
+
+    @classmethod
+    def invalidate_serialized(cls, users):
+        """
+        Removes the users from the user cache.
+        """
+        USER_CACHE.delete(*[cls.get_user_key(int(user)) for user in users])
+
+    @classmethod
+    def write(cls, users, values):
+        """
+        Removes the written users from the user cache.
+        """
+        super(NereidUser, cls).write(users, values)
+        cls.invalidate_serialized(users)
+
+    @classmethod
+    def delete(cls, users):
+        """
+        Removes the deleted users from the user cache.
+        """
+        cls.invalidate_serialized(users)
+        super(NereidUser, cls).delete(users)
+
     def get_chat_friends(self):
         """
         Returns list of friends of nereid_user. This is separated so that
@@ -139,7 +216,74 @@ class NereidUser(ModelSQL, ModelView):
 
         :return: List of browse records of friends.
         """
-        return self.search([('id', '!=', self.id)])
+        return self.search(self.get_chat_friends_domain())
+
+    def get_chat_friends_domain(self):
+        """
+        Returns the domain of the friends of nereid_user, which the friends
+        are searched on in the database, by pages. Modules which change the
+        friends may extend this instead of :meth:`get_chat_friends`.
+        """
+        return [('id', '!=', self.id)]
+
+    def chat_friends_overridden(self):
+        """
+        Returns True if a module overrides :meth:`get_chat_friends`, whose
+        list of friends is then used instead of the domain.
+        """
+        return type(self).get_chat_friends.im_func is not \
+            NereidUser.get_chat_friends.im_func
+
+    def get_chat_friends_page(self, offset=0, limit=None):
+        """
+        Returns a page of the friends of nereid_user and the total number of
+        friends. The page is selected in the database, which reads only the
+        ids of the friends, unless :meth:`get_chat_friends` is overridden.
+
+        :return: Tuple of the list of browse records and the total.
+        """
+        if self.chat_friends_overridden():
+            friends = self.get_chat_friends()
+            end = offset + limit if limit is not None else None
+            return friends[offset:end], len(friends)
+
+        domain = self.get_chat_friends_domain()
+        cursor = Transaction().cursor
+        cursor.execute(*self.search(
+            domain, offset=offset, limit=limit, query=True
+        ))
+        page = self.browse([id for id, in cursor.fetchall()])
+        return page, self.search_count(domain)
+
+    def get_online_chat_friends(self):
+        """
+        Returns the friends of the nereid_user who have a stream connected.
+        Presence is published only to them, the others get the presence of
+        their friends when they connect.
+
+        :return: List of browse records of friends.
+        """
+        online = MQ.get_online_users()
+        if not online:
+            return []
+        if self.chat_friends_overridden():
+            return [
+                friend for friend in self.get_chat_friends()
+                if friend.id in online
+            ]
+        # Only the ids of the friends online are read, by chunks of the
+        # size the database takes in a query
+        cursor = Transaction().cursor
+        domain = self.get_chat_friends_domain()
+        online = list(online)
+        ids = []
+        for index in xrange(0, len(online), cursor.IN_MAX):
+            cursor.execute(*self.search(
+                domain + [('id', 'in', online[index:index + cursor.IN_MAX])],
+                query=True
+            ))
+            ids.extend(id for id, in cursor.fetchall())
+        return self.browse(ids)
 
     def publish_message(self, data_message):
         '''
@@ -147,16 +291,27 @@ class NereidUser(ModelSQL, ModelView):
         '''
         return MQ.publish(self.id, data_message)
 
-    def broadcast_presence(self):
+    def broadcast_presence(self, force=False):
         '''
         Publishes presence to all friends.
+
+        The presence is published only if it changed since the last
+        broadcast or if that was sent before the debounce window.
+
+        :param force: Publish even if the presence did not change.
         '''
-        presence_message = {
+        dbname = Transaction().cursor.dbname
+        presence = self.get_presence()
+        if not MQ.presence_changed(self.id, presence) and not force:
+            PRESENCE_SUPPRESSED.inc((dbname,))
+            return
+        presence_message = Stanza({
             "timestamp": datetime.utcnow().isoformat(),
             "type": "presence",
-            "presence": self.get_presence(),
-        }
-        friends = self.get_chat_friends()
+            "presence": presence,
+        })
+        friends = self.get_online_chat_friends()
+        PRESENCE_FANOUT.observe((dbname,), len(friends))
         for user in friends:
             MQ.publish(user.id, presence_message)
 
@@ -167,24 +322,59 @@ class NereidUser(ModelSQL, ModelView):
         """
         GET: Returns the JSON dictionary of all chat friends with their
         presence stanza.
+            offset: (optional) Number of friends to skip, Default: 0
+            limit: (optional) Maximum number of friends to return
+
+        :return: JSON as {
+                'friends': list of presence stanzas,
+                'total': total number of friends,
+            }
         """
-        friends = request.nereid_user.get_chat_friends()
-        friends_presence = []
-        for friend in friends:
-            friends_presence.append(friend.get_presence())
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', None, type=int)
+        if limit is not None:
+            limit = max(0, limit)
+
+        page, total = request.nereid_user.get_chat_friends_page(
+            offset, limit
+        )
         return jsonify({
-            'friends': friends_presence,
+            'friends': cls.get_presences(page),
+            'total': total,
         })
 
-    def get_presence(self):
+    @classmethod
+    def get_presences(cls, users):
+        '''
+        Returns the presence stanzas of the users. The availability of all
+        the users is looked up at once.
+
+        :param users: List of browse records of nereid_user.
+        '''
+        online = MQ.filter_online([user.id for user in users])
+        # Serialize the users, those which are not cached yet at once
+        entities = cls.get_serialized(users)
+        return [
+            user.get_presence(available=user.id in online, entity=entity)
+            for user, entity in zip(users, entities)
+        ]
+
+    def get_presence(self, available=None, entity=None):
         '''
         Returns the presence status of a nereid_user.
+
+        :param available: The availability of the user if already known.
+        :param entity: The serialized user if already known.
         '''
+        if available is None:
+            available = self.chat_available
+        if entity is None:
+            entity, = self.get_serialized([self])
         return {
-            "entity": self.serialize(),
+            "entity": entity,
             "show": "chat",
             "status": None,
-            'available': self.chat_available,
+            'available': available,
         }
 
     def can_chat(self, other):
@@ -209,6 +399,8 @@ class NereidChat(ModelSQL, ModelView):
     members = fields.One2Many(
         'nereid.chat.member', 'chat', 'Members',
     )
+    #: The canonical key of the set of members, see :meth:`get_member_key`
+    member_key = fields.Char('Member Key', select=True, readonly=True)
 
     #: This POC implementation uses the database backend to store messages.
     #: This should not be used in production as this may cause too many writes
@@ -223,8 +415,45 @@ class NereidChat(ModelSQL, ModelView):
         cls._sql_constraints += [
             ('unique_thread', 'UNIQUE(thread)',
                 'Thread should be unique.'),
+            ('unique_member_key', 'UNIQUE(member_key)',
+                'There is already a chat with these members.'),
         ]
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        ChatMember = Pool().get('nereid.chat.member')
+        cursor = Transaction().cursor
+
+        super(NereidChat, cls).__register__(module_name)
+
+        # Migration: set the member key of the existing chats. If there are
+        # several chats with the same members, only the first gets the key.
+        if not TableHandler.table_exist(cursor, ChatMember._table):
+            return
+        chat = cls.__table__()
+        member = ChatMember.__table__()
+        cursor.execute(*chat.select(
+            chat.member_key, where=chat.member_key != None  # noqa
+        ))
+        member_keys = set(member_key for member_key, in cursor.fetchall())
+        cursor.execute(*chat.join(
+            member, condition=member.chat == chat.id
+        ).select(
+            chat.id, member.user, where=chat.member_key == None  # noqa
+        ))
+        members = {}
+        for chat_id, user in cursor.fetchall():
+            members.setdefault(chat_id, []).append(user)
+        for chat_id in sorted(members):
+            member_key = cls.get_member_key(members[chat_id])
+            if member_key in member_keys:
+                continue
+            member_keys.add(member_key)
+            cursor.execute(*chat.update(
+                [chat.member_key], [member_key], where=chat.id == chat_id
+            ))
+
     @staticmethod
     def default_thread():
         '''
@@ -287,8 +516,8 @@ class NereidChat(ModelSQL, ModelView):
         )
         return jsonify({
             'thread_id': chat.thread,
-            'members': map(
-                lambda m: m.user.serialize(), chat.members
+            'members': NereidUser.get_serialized(
+                [m.user for m in chat.members]
             )
         })
 
@@ -302,37 +531,264 @@ class NereidChat(ModelSQL, ModelView):
         to test the functionality and also customize for future
         modules.
 
+        The room is looked up by the key of its member set. If another
+        request creates the same room at the same time, the unique
+        constraint on the key fails the later one, which then returns the
+        room created by the other.
+
         :return: No matter what happened a browse record of chat room is
                  returned
         """
-        domain = [
-            ('members.user', '=', owner),
-        ]
+        member_key = cls.get_member_key([owner] + list(users))
+        chats = cls.search([('member_key', '=', member_key)], limit=1)
+        if chats:
+            return chats[0]
+
+        # create a chat since one does not exist
+        members = [{
+            'user': int(owner),
+            'role': 'owner'
+        }]
         for user in users:
-            domain.append(('members.user', '=', user))
+            members.append({
+                'user': int(user),
+                'role': 'guest'
+            })
+        values = {
+            'member_key': member_key,
+            'members': [('create', members)],
+        }
+
+        # A failed statement aborts the whole transaction on postgres, so
+        # the room is created in a savepoint to look it up after a conflict.
+        # Sqlite runs the transactions one at a time anyway.
+        cursor = Transaction().cursor
+        savepoint = CONFIG['db_type'] == 'postgresql'
+        if savepoint:
+            cursor.execute('SAVEPOINT nereid_chat_room')
+        try:
+            chat, = cls.create([values])
+        except Exception:
+            if not savepoint:
+                raise
+            cursor.execute('ROLLBACK TO SAVEPOINT nereid_chat_room')
+            chats = cls.search([('member_key', '=', member_key)], limit=1)
+            if not chats:
+                raise
+            chat, = chats
+        else:
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT nereid_chat_room')
+        return chat
+
+    @staticmethod
+    def get_member_key(users):
+        """
+        Returns the canonical key of a set of members, a hash of their
+        sorted ids.
+
+        :param users: List of ids or browse records of nereid_user.
+        """
+        return hashlib.sha1(
+            ','.join(map(str, sorted(set(map(int, users)))))
+        ).hexdigest()
+
+    @classmethod
+    def update_member_keys(cls, chats):
+        """
+        Set the member key of the chats from their current members. A chat
+        whose members become those of another chat loses its key, so that
+        the other one stays the room of these members.
+        """
+        for chat in cls.browse(map(int, chats)):
+            member_key = cls.get_member_key([m.user for m in chat.members])
+            if chat.member_key == member_key:
+                continue
+            if cls.search([
+                    ('member_key', '=', member_key),
+                    ('id', '!=', chat.id),
+                    ], limit=1):
+                member_key = None
+            cls.write([chat], {'member_key': member_key})
+
+    @classmethod
+    def members_changed(cls, chats, removed=(), added=()):
+        """
+        Called when members are added to or removed from the chats.
+
+        :param removed: List of the (thread id, user id) of the members
+                        removed.
+        :param added: List of the (thread id, user id) of the members
+                      added.
+        """
+        cls.update_member_keys(chats)
+        cls.invalidate_threads(chats)
+        cls.invalidate_rooms([
+            member.user.id
+            for chat in cls.browse(map(int, chats))
+            for member in chat.members
+        ] + [user_id for _, user_id in removed])
+        cls.notify_rooms(chats, removed, added)
+
+    @staticmethod
+    def is_room(members):
+        """
+        Returns True if the thread of the members is a room. The messages of
+        a room are published once on the channel of the room, to which the
+        streams of the members are joined, instead of to each member.
+        """
+        return len(members) >= ROOM_SIZE
+
+    @classmethod
+    def get_roster(cls, thread_id, members):
+        """
+        Returns the `join` stanza of the room, which carries the serialized
+        members and is sent to the streams of the members as they join.
+
+        :param members: The ids of the members.
+        """
+        NereidUser = Pool().get('nereid.user')
+
+        return Stanza({
+            "timestamp": datetime.utcnow().isoformat(),
+            "type": "join",
+            "thread": thread_id,
+            "members": NereidUser.get_serialized(members),
+        })
+
+    @staticmethod
+    def get_rooms_key(user):
+        """
+        Returns the key of the rooms of the user in the room cache
+        """
+        return '%s:%s' % (Transaction().cursor.dbname, user)
+
+    @classmethod
+    def get_rooms(cls, user):
+        """
+        Returns the rooms of the user, for a stream of the user to join, as
+        a dictionary of the thread ids to their roster. The thread ids of
+        the rooms are kept in the room cache, so that the streams which
+        connect do not search the chats of the user.
+
+        :param user: Id of the nereid_user.
+        """
+        ChatMember = Pool().get('nereid.chat.member')
+
+        key = cls.get_rooms_key(user)
+        thread_ids = ROOM_CACHE.get(key)
+        if thread_ids is None:
+            thread_ids = [
+                member.chat.thread
+                for member in ChatMember.search([('user', '=', user)])
+                if cls.is_room(cls.get_thread(member.chat.thread)['members'])
+            ]
+            ROOM_CACHE.set(key, thread_ids)
+
+        rooms = {}
+        for thread_id in thread_ids:
+            thread = cls.get_thread(thread_id)
+            if thread is not None:
+                rooms[thread_id] = cls.get_roster(
+                    thread_id, thread['members']
+                )
+        return rooms
+
+    @classmethod
+    def invalidate_rooms(cls, users):
+        """
+        Removes the rooms of the users from the room cache.
+        """
+        ROOM_CACHE.delete(*[cls.get_rooms_key(user) for user in users])
+
+    @classmethod
+    def notify_rooms(cls, chats, removed=(), added=()):
+        """
+        Send the roster of the rooms among the chats to their members, and
+        a `leave` stanza to the members removed. The roster is published
+        once on the channel of a room, but to each member of a thread which
+        just became a room and to the members added, as their streams join
+        the room when they get it.
+        """
+        for chat in cls.browse(map(int, chats)):
+            members = [member.user.id for member in chat.members]
+            if not cls.is_room(members):
+                continue
+            roster = cls.get_roster(chat.thread, members)
+            joining = set(
+                user_id for thread_id, user_id in added
+                if thread_id == chat.thread
+            )
+            before = set(members) - joining | set(
+                user_id for thread_id, user_id in removed
+                if thread_id == chat.thread
+            )
+            if cls.is_room(before):
+                MQ.publish_room(chat.thread, roster)
+            else:
+                joining = members
+            for user_id in joining:
+                MQ.publish(user_id, roster)
+        for thread_id, user_id in removed:
+            MQ.publish(user_id, {
+                "timestamp": datetime.utcnow().isoformat(),
+                "type": "leave",
+                "thread": thread_id,
+            })
+
+    @staticmethod
+    def get_thread_key(thread_id):
+        """
+        Returns the key of the thread in the thread cache
+        """
+        return '%s:%s' % (Transaction().cursor.dbname, thread_id)
 
-        chats = cls.search(domain, limit=1)
+    @classmethod
+    def get_thread(cls, thread_id):
+        """
+        Returns the chat of the thread as a dictionary with its `id` and the
+        ids of the users who are `members`. The dictionary is kept in the
+        thread cache, so that known threads are not read from the database.
 
+        :return: The dictionary, or None if there is no such thread.
+        """
+        key = cls.get_thread_key(thread_id)
+        thread = THREAD_CACHE.get(key)
+        if thread is not None:
+            return thread
+
+        chats = cls.search([('thread', '=', thread_id)], limit=1)
         if not chats:
-            # create a chat since one does not exist
-            values = {
-                'members': [
-                    ('create', [{
-                        'user': owner,
-                        'role': 'owner'
-                    }]),
-                ]
-            }
-            for user in users:
-                values['members'].append((
-                    'create', [{
-                        'user': user,
-                        'role': 'guest'
-                    }]
-                ))
-            chats = cls.create([values])
+            return None
+        chat, = chats
+        thread = {
+            'id': chat.id,
+            'members': [member.user.id for member in chat.members],
+        }
+        THREAD_CACHE.set(key, thread)
+        return thread
+
+    @classmethod
+    def invalidate_threads(cls, chats):
+        """
+        Removes the threads of the chats from the thread cache.
+        """
+        THREAD_CACHE.delete(*[
+            cls.get_thread_key(chat.thread)
+            for chat in cls.browse(map(int, chats))
+        ])
 
-        return chats[0]
+    @classmethod
+    def delete(cls, chats):
+        """
+        Removes the threads of the deleted chats from the thread cache and
+        the rooms of their members from the room cache.
+        """
+        cls.invalidate_threads(chats)
+        cls.invalidate_rooms([
+            member.user.id for chat in chats for member in chat.members
+        ])
+        super(NereidChat, cls).delete(chats)
 
     @classmethod
     @route('/nereid-chat/send-message', methods=['POST'])
@@ -348,60 +804,156 @@ class NereidChat(ModelSQL, ModelView):
                 'UUID': 'unique id of message',
             }
         '''
-        try:
-            chat, = cls.search([
-                ('thread', '=', request.form['thread_id']),
-                ('members.user', '=', request.nereid_user.id)
-            ])
-        except ValueError:
+        with timed(SEND_MESSAGE_SECONDS, (Transaction().cursor.dbname,)):
+            message_id = cls.post_message(
+                request.nereid_user, request.form['thread_id'],
+                request.form['message'], request.form.get('type', 'plain'),
+            )
+        if message_id is None:
             abort(404)
 
+        return jsonify({
+            'UUID': message_id,
+        })
+
+    @classmethod
+    def post_message(cls, sender, thread_id, text, type='plain'):
+        '''
+        Publish a message of the sender to the members of a thread.
+
+        :param sender: Browse record of the nereid_user sending.
+        :param thread_id: Thread id of the chat.
+        :param text: The text of the message.
+        :param type: Type of message.
+        :return: The unique id of the message, or None if the sender is not
+                 a member of the thread.
+
+        The message carries the serialized `members` of the thread, but for
+        the rooms, whose members get them when they join, see
+        :meth:`get_rooms`.
+
+        If the hub traces the messages, the time spent in each stage of the
+        delivery is observed from here on, see :class:`metrics.Trace`.
+        '''
+        NereidUser = Pool().get('nereid.user')
+        trace = Trace() if MQ.trace else None
+
+        thread = cls.get_thread(thread_id)
+        if thread is None or sender.id not in thread['members']:
+            return None
+        chat = cls(thread['id'], thread=thread_id)
+        room = cls.is_room(thread['members'])
+
         data_message = {
             "timestamp": datetime.utcnow().isoformat(),
             "type": "message",
             "message": {
                 "subject": None,
-                "text": request.form['message'],
-                "type": request.form.get('type', 'plain'),
+                "text": text,
+                "type": type,
                 "language": "en_US",
                 "attachments": [],
                 "id": unicode(uuid.uuid4()),
-                "thread": chat.thread,
-                "sender": request.nereid_user.serialize(),
-                'members': map(
-                    lambda m: m.user.serialize(),
-                    chat.members
-                )
+                "thread": thread_id,
             }
         }
+        if room:
+            data_message['message']['sender'], = NereidUser.get_serialized(
+                [sender.id]
+            )
+        else:
+            members = NereidUser.get_serialized(thread['members'])
+            data_message['message'].update({
+                "sender": members[thread['members'].index(sender.id)],
+                "members": members,
+            })
+
+        # Encode the message once for the database and all receivers
+        stanza = Stanza(data_message)
+        stanza.trace = trace
+        dbname = Transaction().cursor.dbname
 
         # Save the message to messages list
-        cls.save_message(chat, request.nereid_user, data_message)
+        cls.save_message(chat, sender, stanza)
+        if trace is not None:
+            trace.stamp(dbname, 'persist', 'accept')
 
         # Publish my presence too
-        request.nereid_user.broadcast_presence()
+        sender.broadcast_presence()
+        if trace is not None:
+            trace.stamp(dbname, 'presence', 'persist')
 
         # Publish the message to the queue system
-        for receiver in chat.members:
-            receiver.user.publish_message(data_message)
+        if room:
+            MQ.publish_room(thread_id, stanza)
+        else:
+            for user_id in thread['members']:
+                NereidUser(user_id).publish_message(stanza)
+        if trace is not None:
+            trace.stamp(dbname, 'publish', 'presence')
 
-        return jsonify({
-            'UUID': unicode(data_message['message']['id']),
-        })
+        return data_message['message']['id']
 
     @classmethod
     def save_message(cls, chat, user, data_message):
         '''
-        This should not be used in production as saving each chat message to
-        the database might be costly
+        Save the message to the message store, which by default keeps the
+        messages in the database. This should not be used in production as
+        saving each chat message to the database might be costly, use the
+        write behind buffer or another store.
+
+        :param data_message: The message as a dictionary or as a
+                             :class:`Stanza` if already encoded.
+        :return: What the store returns, a record of the message by default
+        '''
+        if isinstance(data_message, Stanza):
+            message = data_message.payload
+        else:
+            message = json.dumps(data_message)
+        with timed(SAVE_MESSAGE_SECONDS, (Transaction().cursor.dbname,)):
+            return MESSAGE_STORE.append(chat, user, message)
+
+    @classmethod
+    @route('/nereid-chat/history/<thread_id>')
+    @login_required
+    def history(cls, thread_id):
+        '''
+        GET: Returns the messages of a thread, the latest first.
+            before: (optional) Cursor returned as `next` by the previous
+                    page, to get the messages older than that page.
+            limit: (optional) Number of messages, Default: 50, from 1 to 200
+
+        :return: JSON as {
+                'messages': list of message stanzas,
+                'next': cursor of the next page or null if there is none,
+            }
         '''
-        Message = Pool().get('nereid.chat.message')
+        try:
+            chat, = cls.search([
+                ('thread', '=', thread_id),
+                ('members.user', '=', request.nereid_user.id)
+            ])
+        except ValueError:
+            abort(404)
+
+        limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+        try:
+            messages = MESSAGE_STORE.range(
+                chat, before=request.args.get('before'), limit=limit
+            )
+        except ValueError:
+            abort(400, "Invalid cursor")
+        next_cursor = messages[-1][0] if len(messages) == limit else None
 
-        return Message.create([{
-            'chat': chat.id,
-            'message': json.dumps(data_message),
-            'user': user.id
-        }])[0]
+        # The stored messages are already JSON, so they are not decoded and
+        # encoded again
+        return Response(
+            '{"messages": [%s], "next": %s}' % (
+                ', '.join(payload for _, payload in messages),
+                json.dumps(next_cursor),
+            ),
+            mimetype='application/json'
+        )
 
     @classmethod
     @route('/nereid-chat/token', methods=['POST'])
@@ -410,19 +962,12 @@ class NereidChat(ModelSQL, ModelView):
         '''
         Generate token for current_user with TTL of 1 hr.
         '''
-        if hasattr(current_app, 'redis_client'):
-            redis_client = current_app.redis_client
-        else:
-            redis_client = Redis(
-                CONFIG.get('redis_host', 'localhost'),
-                int(CONFIG.get('redis_port', 6379))
-            )
+        redis_client = get_redis_client()
 
         token = unicode(uuid.uuid4())
         key = 'chat:token:%s' % token
-        # Save token to redis and set TTL of 1 hr.
-        redis_client.set(key, current_user.id)
-        redis_client.expire(key, 3600)
+        # Save token to redis with a TTL of 1 hr.
+        redis_client.set(key, current_user.id, ex=3600)
 
         return jsonify({
             'token': token
@@ -436,15 +981,7 @@ class NereidChat(ModelSQL, ModelView):
         Set user to online and publish presence of this user to all
         friends.
         '''
-        request.nereid_user.broadcast_presence()
-
-        return Response(
-            cls.generate_event_stream(
-                request.nereid_user.id,
-                Transaction().cursor.dbname
-            ),
-            mimetype='text/event-stream'
-        )
+        return cls.serve_stream(request.nereid_user)
 
     @classmethod
     @route('/nereid-chat/stream/<token>')
@@ -453,43 +990,239 @@ class NereidChat(ModelSQL, ModelView):
         Set token user to online and publish presence of this user to all
         friends.
         '''
-        NereidUser = Pool().get('nereid.user')
-
-        if hasattr(current_app, 'redis_client'):
-            redis_client = current_app.redis_client
-        else:
-            redis_client = Redis(
-                CONFIG.get('redis_host', 'localhost'),
-                int(CONFIG.get('redis_port', 6379))
-            )
+        return cls.serve_stream(cls.get_token_user(token))
 
-        key = 'chat:token:%s' % token
-        if not redis_client.exists(key):
-            abort(404)
+    @classmethod
+    def serve_stream(cls, user):
+        '''
+        Serve the event stream of the request for the user. The stream is
+        subscribed before the presence of the user is broadcast, as the
+        presence comes from the streams connected.
 
-        nereid_user = NereidUser(int(redis_client.get(key)))
-        nereid_user.broadcast_presence()
+        :param user: Browse record of the nereid_user connected.
+        '''
+        dbname = Transaction().cursor.dbname
+        subscription = MQ.subscribe(user.id, dbname, cls.get_rooms(user.id))
+        user.broadcast_presence()
 
-        return Response(
+        response = Response(
             cls.generate_event_stream(
-                nereid_user.id,
-                Transaction().cursor.dbname
+                user.id, dbname,
+                request.args.get('batch', 0, type=int),
+                cls.get_last_event_id(),
+                subscription=subscription,
             ),
             mimetype='text/event-stream'
         )
+        # The stream releases the subscription, unless it is closed before
+        # it starts
+        response.call_on_close(lambda: MQ.unsubscribe(subscription))
+        return response
+
+    @classmethod
+    def get_token_user(cls, token):
+        '''
+        Returns the nereid_user the chat token was generated for, and
+        aborts with 404 if the token is not valid.
+        '''
+        NereidUser = Pool().get('nereid.user')
+
+        user_id = TOKEN_CACHE.get(token)
+        if user_id is None:
+            user_id = get_redis_client().get('chat:token:%s' % token)
+            if user_id is None:
+                abort(404)
+            TOKEN_CACHE.set(token, user_id)
+        return NereidUser(int(user_id))
+
+    @classmethod
+    @route('/nereid-chat/metrics')
+    def metrics(cls):
+        '''
+        The metrics of the chat in this process, in the text format of
+        Prometheus. If the `chat_metrics_token` option of the tryton config
+        is set, the request must bring it as a bearer token.
+        '''
+        token = CONFIG.get('chat_metrics_token')
+        if token and request.headers.get('Authorization') != \
+                'Bearer %s' % token:
+            abort(403)
+        return Response(
+            REGISTRY.render(), mimetype='text/plain; version=0.0.4'
+        )
+
+    @classmethod
+    @route('/nereid-chat/socket')
+    @login_required
+    def socket(cls):
+        '''
+        A websocket carrying the stanzas both ways: the stanzas addressed
+        to the user are sent on it and the messages of the user are
+        received on it. The server must be run with the handler of
+        gevent-websocket.
+        '''
+        return cls.serve_socket(request.nereid_user)
+
+    @classmethod
+    @route('/nereid-chat/socket/<token>')
+    def socket_via_token(cls, token):
+        '''
+        The websocket of the user of the chat token.
+        '''
+        return cls.serve_socket(cls.get_token_user(token))
+
+    @classmethod
+    def serve_socket(cls, user):
+        '''
+        Serve the websocket of the request for the user until it is closed.
+        The stanzas for the user are sent from a greenlet of their own while
+        the stanzas received are handled as they come, each committed on
+        its own. See :func:`stream_cursor` for the cursor of the request.
+
+        :param user: Browse record of the nereid_user connected.
+        '''
+        websocket = request.environ.get('wsgi.websocket')
+        if websocket is None:
+            abort(400, "A websocket connection is expected")
+
+        dbname = Transaction().cursor.dbname
+        STREAMS_OPENED.inc((dbname, 'websocket'))
+        subscription = MQ.subscribe(user.id, dbname, cls.get_rooms(user.id))
+        user.broadcast_presence()
+        sender = gevent.spawn(cls.send_to_socket, websocket, subscription)
+        try:
+            with stream_cursor(dbname):
+                while True:
+                    data = websocket.receive()
+                    if data is None:
+                        break
+                    with stanza_cursor(dbname):
+                        reply = cls.receive_from_socket(user, data)
+                    if reply is not None:
+                        websocket.send(json.dumps(reply))
+        finally:
+            sender.kill()
+            MQ.unsubscribe(subscription)
+        return Response()
+
+    @staticmethod
+    def send_to_socket(websocket, subscription):
+        '''
+        Send the stanzas of the subscription on the websocket as they come.
+        '''
+        while True:
+            try:
+                stanza = subscription.get()
+            except queue.Empty:
+                # Nothing to keep alive, websockets have ping frames
+                continue
+            dequeued = time.time()
+            websocket.send(stanza.payload)
+            if stanza.trace is not None:
+                stanza.trace.delivered(
+                    subscription.dbname, 'websocket', dequeued
+                )
+
+    @classmethod
+    def receive_from_socket(cls, user, data):
+        '''
+        Handle a stanza received on the websocket of the user and return
+        the reply to send, if any. A stanza of type `message` is published
+        as if it were posted to `send_message`, and a stanza of type
+        `presence` broadcasts the presence of the user again.
+
+        The reply is an `ack` stanza with the `UUID` of the message sent, or
+        an `error` stanza. Either carries the `ref` of the stanza received,
+        if given.
+        '''
+        try:
+            stanza = json.loads(data)
+        except (ValueError, TypeError):
+            stanza = None
+        if not isinstance(stanza, dict) or \
+                not isinstance(stanza.get('type'), basestring):
+            return {'type': 'error', 'ref': None, 'error': 'Invalid stanza'}
+        type = stanza['type']
+
+        reply = {'type': 'ack', 'ref': stanza.get('ref')}
+        if type == 'message':
+            message = stanza.get('message')
+            if not isinstance(message, dict) or \
+                    not isinstance(message.get('thread'), basestring) or \
+                    not message['thread'] or \
+                    not isinstance(message.get('text'), basestring) or \
+                    not isinstance(message.get('type', 'plain'), basestring):
+                reply.update(type='error', error='Invalid message')
+                return reply
+            with timed(
+                    SEND_MESSAGE_SECONDS, (Transaction().cursor.dbname,)):
+                message_id = cls.post_message(
+                    user, message['thread'], message['text'],
+                    message.get('type', 'plain'),
+                )
+            if message_id is None:
+                reply.update(type='error', error='Not found')
+            else:
+                reply['UUID'] = message_id
+        elif type == 'presence':
+            user.broadcast_presence(force=True)
+        else:
+            reply.update(type='error', error='Unknown stanza')
+        return reply
 
     @staticmethod
-    def generate_event_stream(user, dbname):
+    def generate_event_stream(
+            user, dbname, batch=False, last_event_id=None, rooms=None,
+            subscription=None):
         '''
         Subscribe to chats addressed to the user and all the presence
         notifications addressed to the user.
 
         :param dbname: Optionally specify the dbname, if the transaction
                        context is not available
-        :return: stream of a channel.
+        :param batch: If True, the stanzas ready at once are sent together
+                      in one frame using the `stanzas` envelope.
+        :param last_event_id: The id of the last event received by the
+                              client, to resume the stream from.
+        :param rooms: The rooms the stream joins, as returned by
+                      :meth:`get_rooms`.
+        :param subscription: The subscription of the user, if it was made
+                             before the stream starts.
+        :return: stream of a channel. The frames are encoded once when the
+                 stanza is published and shared by all the recipients.
+
+        A traced stanza is flushed once the server asks for the next frame,
+        which it does after writing the frame of the stanza.
         '''
-        for item in MQ.listen(user, dbname):
-            yield 'data: %s\n\n' % json.dumps(item)
+        STREAMS_OPENED.inc((dbname, 'sse'))
+        with stream_cursor(dbname):
+            if batch:
+                for stanzas in MQ.listen_batches(
+                        user, dbname, last_event_id, rooms, subscription):
+                    dequeued = time.time()
+                    yield batch_frame(stanzas)
+                    for stanza in stanzas:
+                        if stanza.trace is not None:
+                            stanza.trace.delivered(dbname, 'sse', dequeued)
+            else:
+                for stanza in MQ.listen(
+                        user, dbname, last_event_id, rooms, subscription):
+                    if stanza.trace is None:
+                        yield stanza.frame
+                        continue
+                    dequeued = time.time()
+                    yield stanza.frame
+                    stanza.trace.delivered(dbname, 'sse', dequeued)
+
+    @staticmethod
+    def get_last_event_id():
+        '''
+        Returns the id of the last event received by the reconnecting
+        stream, sent by the browser in the `Last-Event-ID` header or by the
+        client in the `last_event_id` argument.
+        '''
+        return request.headers.get('Last-Event-ID') or \
+            request.args.get('last_event_id')
 
 
 class ChatMember(ModelSQL):
@@ -516,6 +1249,47 @@ class ChatMember(ModelSQL):
         '''
         return 'guest'
 
+    @classmethod
+    def create(cls, vlist):
+        '''
+        Notify the chats the members are added to.
+        '''
+        Chat = Pool().get('nereid.chat')
+
+        members = super(ChatMember, cls).create(vlist)
+        Chat.members_changed(
+            set(m.chat for m in members),
+            added=[(m.chat.thread, m.user.id) for m in members],
+        )
+        return members
+
+    @classmethod
+    def write(cls, members, values):
+        '''
+        Notify the chats the members move from and to.
+        '''
+        Chat = Pool().get('nereid.chat')
+
+        chats = set(m.chat for m in members)
+        before = set((m.chat.thread, m.user.id) for m in members)
+        super(ChatMember, cls).write(members, values)
+        members = cls.browse(map(int, members))
+        chats.update(m.chat for m in members)
+        after = set((m.chat.thread, m.user.id) for m in members)
+        Chat.members_changed(chats, before - after, after - before)
+
+    @classmethod
+    def delete(cls, members):
+        '''
+        Notify the chats the members are removed from.
+        '''
+        Chat = Pool().get('nereid.chat')
+
+        chats = set(m.chat for m in members)
+        removed = [(m.chat.thread, m.user.id) for m in members]
+        super(ChatMember, cls).delete(members)
+        Chat.members_changed(chats, removed)
+
 
 class Message(ModelSQL):
     '''
@@ -532,8 +1306,10 @@ class Message(ModelSQL):
     '''
     __name__ = 'nereid.chat.message'
 
-    create_date = fields.DateTime('Create Date', select=True)
-    chat = fields.Many2One('nereid.chat', 'Chat', select=True, required=True)
+    #: The history of a chat is read with the index on (chat, create_date)
+    #: created in :meth:`__register__`
+    create_date = fields.DateTime('Create Date')
+    chat = fields.Many2One('nereid.chat', 'Chat', required=True)
     user = fields.Many2One('nereid.user', 'User', select=True, required=True)
     message = fields.Text('Message')
 
@@ -541,3 +1317,12 @@ class Message(ModelSQL):
     def __setup__(cls):
         super(Message, cls).__setup__()
         cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(Message, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(['chat', 'create_date'], action='add')
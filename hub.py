@@ -0,0 +1,1464 @@
+# -*- coding: utf-8 -*-
+"""
+    hub
+
+    The message hub which carries stanzas from the publishers to the event
+    streams of the users.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+import math
+import time
+from datetime import datetime
+from collections import deque, OrderedDict
+from itertools import count
+
+import gevent
+from gevent import queue
+from gevent.event import Event
+from redis import Redis, BlockingConnectionPool, ConnectionError, \
+    ResponseError
+import simplejson as json
+from nereid import current_app
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+
+from metrics import Counter, Gauge, Trace, PUBLISHED
+
+__all__ = [
+    'Stanza', 'Delivery', 'Usage', 'Buffer', 'Subscription', 'KeepaliveWheel',
+    'MessageQueue', 'RedisMessageQueue', 'RedisMixin', 'batch_frame',
+    'get_redis_client', 'get_message_queue',
+]
+
+logger = logging.getLogger('nereid_chat.hub')
+
+
+_redis_client = None
+
+
+def get_redis_client():
+    '''
+    Returns the redis client of the current application if one is set,
+    else the client of the process connected to the redis server in the
+    tryton config.
+
+    The client of the process shares a pool of connections, which are
+    checked before use once idle for `chat_redis_health_check` seconds.
+    When all the `chat_redis_max_connections` are in use, the callers wait
+    for one to be released instead of opening more.
+    '''
+    global _redis_client
+    if current_app and hasattr(current_app, 'redis_client'):
+        return current_app.redis_client
+    if _redis_client is None:
+        _redis_client = Redis(connection_pool=BlockingConnectionPool(
+            host=CONFIG.get('redis_host', 'localhost'),
+            port=int(CONFIG.get('redis_port', 6379)),
+            max_connections=int(
+                CONFIG.get('chat_redis_max_connections', 50)
+            ),
+            timeout=int(CONFIG.get('chat_redis_pool_timeout', 5)),
+            health_check_interval=int(
+                CONFIG.get('chat_redis_health_check', 30)
+            ),
+            socket_keepalive=True,
+        ))
+    return _redis_client
+
+
+class RedisMixin(object):
+    '''
+    Gives the `redis` client of :func:`get_redis_client`, bound lazily
+    since the hub, caches and stores are created before the application
+    is.
+    '''
+    _redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_client()
+        return self._redis
+
+
+class Stanza(object):
+    '''
+    A stanza encoded once at publish time. The same instance is handed to
+    the buffers of all the recipients, so it must not be changed.
+
+    :param data: The stanza as a dictionary.
+    :param payload: The stanza already encoded as JSON, if available.
+    :param type: The type of the stanza, required if data is not given.
+    '''
+    __slots__ = ('type', 'payload', 'frame', 'trace')
+
+    def __init__(self, data=None, payload=None, type=None):
+        if payload is None:
+            payload = json.dumps(data)
+        if type is None:
+            type = data.get('type')
+        self.type = type
+        self.payload = payload
+        #: The server sent event frame of the stanza
+        self.frame = 'data: %s\n\n' % payload
+        #: The :class:`metrics.Trace` of the stanza, if traced
+        self.trace = None
+
+    def __eq__(self, other):
+        return isinstance(other, Stanza) and self.payload == other.payload
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.payload)
+
+    def __repr__(self):
+        return '<Stanza %s>' % self.payload
+
+
+class Delivery(object):
+    '''
+    A stanza delivered to a user, numbered by the id of the event in the
+    stream of the user. It is read like the stanza, and its frame carries
+    the id so that a reconnecting stream can tell where it stopped.
+
+    :param id: The id of the event.
+    :param stanza: The :class:`Stanza` delivered.
+    '''
+    __slots__ = ('id', 'stanza')
+
+    def __init__(self, id, stanza):
+        self.id = id
+        self.stanza = stanza
+
+    @property
+    def type(self):
+        return self.stanza.type
+
+    @property
+    def payload(self):
+        return self.stanza.payload
+
+    @property
+    def frame(self):
+        return 'id: %s\n%s' % (self.id, self.stanza.frame)
+
+    @property
+    def trace(self):
+        return self.stanza.trace
+
+    def __repr__(self):
+        return '<Delivery %s %s>' % (self.id, self.stanza.payload)
+
+
+#: Sent to streams with nothing to receive, to keep the connection alive.
+#: Its frame is a comment, which the clients ignore.
+KEEPALIVE = Stanza({}, type='keepalive')
+KEEPALIVE.frame = ':\n\n'
+
+
+def batch_frame(stanzas):
+    '''
+    Returns the server sent event frame of the stanzas in the `stanzas`
+    envelope, with the id of the last event among them. The stanzas are
+    not encoded again.
+
+    :param stanzas: List of :class:`Stanza`.
+    '''
+    if not stanzas:
+        return KEEPALIVE.frame
+    frame = 'data: {"timestamp": "%s", "stanzas": [%s]}\n\n' % (
+        datetime.utcnow().isoformat(),
+        ', '.join(stanza.payload for stanza in stanzas),
+    )
+    # The stanzas which are not kept for replay, as presence, have no id
+    for stanza in reversed(stanzas):
+        event_id = getattr(stanza, 'id', None)
+        if event_id is not None:
+            return 'id: %s\n%s' % (event_id, frame)
+    return frame
+
+
+def resync_stanza():
+    '''
+    Returns the stanza telling a reconnecting stream that the events it
+    missed are not all kept anymore, so it has to fetch the state again.
+    '''
+    return Stanza({
+        "timestamp": datetime.utcnow().isoformat(),
+        "type": "resync",
+    })
+
+
+def is_presence(stanza):
+    '''
+    Returns True if the message is a presence stanza
+    '''
+    return stanza.type == 'presence'
+
+
+def parse_id(event_id):
+    '''
+    Returns the id of an event as a key to sort the events by, the ids of
+    the redis streams being two numbers separated by a dash.
+    '''
+    if isinstance(event_id, basestring):
+        return tuple(map(int, event_id.split('-')))
+    return event_id
+
+
+class Usage(dict):
+    '''
+    The memory accounting of the buffers of a database.
+
+        * `buffers`: Number of buffers held.
+        * `messages`: Number of messages held in the buffers.
+        * `dropped`: Number of messages dropped as the buffers were full.
+        * `evicted`: Number of idle queues evicted.
+        * `cursors`: Number of streams holding a cursor of the database.
+    '''
+
+    def __init__(self):
+        super(Usage, self).__init__(
+            buffers=0, messages=0, dropped=0, evicted=0, cursors=0
+        )
+
+
+class Buffer(object):
+    '''
+    A bounded buffer of messages. When the buffer is full a message is
+    dropped according to the overflow policy to make room for the new one:
+
+        * `drop_oldest`: The oldest message is dropped.
+        * `drop_presence`: The oldest presence message is dropped, or the
+          oldest message if there are only chat messages in the buffer.
+
+    :param maxsize: Maximum number of messages. None for unbounded.
+    :param overflow: The overflow policy.
+    :param usage: The usage of the database the buffer belongs to, which is
+                  updated as messages come in and go out.
+    '''
+
+    def __init__(self, maxsize=None, overflow='drop_oldest', usage=None):
+        self.items = deque()
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.usage = usage if usage is not None else Usage()
+        self.last_activity = time.time()
+        self._ready = Event()
+        self._woken = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, data):
+        '''
+        Queue the data, dropping a message if the buffer is full.
+        '''
+        if self.maxsize and len(self.items) >= self.maxsize:
+            self.drop()
+        self.items.append(data)
+        self.usage['messages'] += 1
+        self.last_activity = time.time()
+        self._ready.set()
+
+    def prepend(self, items):
+        '''
+        Queue the items ahead of the messages in the buffer, dropping
+        messages if the buffer is full.
+        '''
+        self.items.extendleft(reversed(items))
+        self.usage['messages'] += len(items)
+        while self.maxsize and len(self.items) > self.maxsize:
+            self.drop()
+        if self.items:
+            self._ready.set()
+
+    def drop(self):
+        '''
+        Drop a message as per the overflow policy.
+        '''
+        if self.overflow == 'drop_presence':
+            for item in self.items:
+                if is_presence(item):
+                    self.items.remove(item)
+                    break
+            else:
+                self.items.popleft()
+        else:
+            self.items.popleft()
+        self.usage['messages'] -= 1
+        self.usage['dropped'] += 1
+
+    def get(self, timeout=None):
+        '''
+        Returns the next message, waiting for at most timeout seconds.
+
+        :raises queue.Empty: if there is no message after the timeout.
+        '''
+        if not self.items and not self._woken:
+            self._ready.clear()
+            self._ready.wait(timeout)
+        self._woken = False
+        if not self.items:
+            raise queue.Empty
+        self.usage['messages'] -= 1
+        return self.items.popleft()
+
+    def drain(self, limit=None):
+        '''
+        Returns the messages which are ready, without waiting.
+
+        :param limit: Maximum number of messages to return.
+        '''
+        items = []
+        while self.items and (limit is None or len(items) < limit):
+            items.append(self.items.popleft())
+        self.usage['messages'] -= len(items)
+        return items
+
+    def wake(self):
+        '''
+        Wake up the reader waiting for a message, or the next one if none
+        is waiting, which gets queue.Empty if there is no message.
+        '''
+        self._woken = True
+        self._ready.set()
+
+    def clear(self):
+        '''
+        Drop all the messages in the buffer.
+        '''
+        self.usage['messages'] -= len(self.items)
+        self.items.clear()
+
+
+class Subscription(Buffer):
+    '''
+    The delivery buffer of a single event stream of a user. Every stream
+    has its own buffer so that all the streams (browser tabs) of a user
+    receive every message.
+    '''
+
+    def __init__(self, dbname, user, *args, **kwargs):
+        super(Subscription, self).__init__(*args, **kwargs)
+        self.dbname = dbname
+        self.user = user
+        #: The slot of the keepalive wheel the subscription is in
+        self.slot = None
+        #: The ids of the events replayed to the stream when it resumed
+        self.replayed = set()
+        #: The ids of the rooms the stream joined
+        self.rooms = set()
+
+    def put(self, data):
+        '''
+        Queue the data unless it was already replayed.
+        '''
+        if self.replayed and getattr(data, 'id', None) in self.replayed:
+            return
+        super(Subscription, self).put(data)
+
+
+class KeepaliveWheel(object):
+    '''
+    A timer wheel which wakes up the streams which have been idle for the
+    interval, so that they send a keepalive. The streams are kept in slots
+    of resolution seconds by when they become due, and every tick only
+    visits the streams of the slot due, so that the streams do not each
+    wake up on a timer of their own.
+
+    :param interval: Seconds a stream may stay idle.
+    :param resolution: Seconds between the ticks.
+    '''
+
+    def __init__(self, interval=15, resolution=1):
+        self.interval = interval
+        self.resolution = resolution
+        size = int(math.ceil(float(interval) / resolution)) + 1
+        self.slots = [set() for _ in range(size)]
+        self.position = 0
+        self._timer = None
+
+    def __len__(self):
+        return sum(map(len, self.slots))
+
+    def add(self, subscription, delay=None):
+        '''
+        Schedule the subscription to be checked after delay seconds, the
+        interval by default.
+        '''
+        if delay is None:
+            delay = self.interval
+        steps = max(1, int(math.ceil(float(delay) / self.resolution)))
+        subscription.slot = (self.position + steps) % len(self.slots)
+        self.slots[subscription.slot].add(subscription)
+        if self._timer is None or self._timer.dead:
+            self._timer = gevent.spawn(self.run)
+
+    def remove(self, subscription):
+        '''
+        Stop checking the subscription.
+        '''
+        slot = getattr(subscription, 'slot', None)
+        if slot is not None:
+            self.slots[slot].discard(subscription)
+            subscription.slot = None
+
+    def clear(self):
+        '''
+        Stop checking all the subscriptions.
+        '''
+        for slot in self.slots:
+            for subscription in slot:
+                subscription.slot = None
+            slot.clear()
+
+    def tick(self, now=None):
+        '''
+        Move to the next slot and wake the subscriptions due which have
+        been idle for the interval. The others are scheduled again for when
+        they will have been.
+        '''
+        now = now or time.time()
+        self.position = (self.position + 1) % len(self.slots)
+        due, self.slots[self.position] = self.slots[self.position], set()
+        for subscription in due:
+            idle = now - subscription.last_activity
+            if idle >= self.interval:
+                subscription.last_activity = now
+                subscription.wake()
+                self.add(subscription)
+            else:
+                self.add(subscription, self.interval - idle)
+
+    def run(self):
+        '''
+        Tick every resolution seconds while there are subscriptions.
+        '''
+        while len(self):
+            gevent.sleep(self.resolution)
+            self.tick()
+
+
+class MessageQueue(object):
+    '''
+    A simple message queue system that will allow this POC to run
+
+    This is also the interface of the hub. The messages are published and
+    delivered within the current process. Backends which carry messages
+    across processes subclass this and change how :meth:`publish` reaches
+    :meth:`deliver`.
+    '''
+
+    def __init__(
+            self, buffer_size=None, backlog_size=None,
+            overflow='drop_oldest', backlog_ttl=None, presence_debounce=0,
+            presence_grace=30, batch_size=50, batch_latency=0,
+            replay_size=0, replay_users=10000, keepalive_interval=15,
+            trace=False):
+        #: Messages waiting for users who have no stream connected
+        self.store = {}
+        #: The live subscriptions of the users
+        self.subscriptions = {}
+        #: The memory accounting of each database
+        self.usage = {}
+        self.buffer_size = buffer_size
+        self.backlog_size = backlog_size
+        self.overflow = overflow
+        self.backlog_ttl = backlog_ttl
+        self._next_eviction = None
+        #: The last presence broadcast of each user and when it was sent
+        self.last_presence = {}
+        self.presence_debounce = presence_debounce
+        #: When the last stream of each user in this process was closed
+        self.last_seen = {}
+        self.presence_grace = presence_grace
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        #: The last events delivered to each user, the most recently used
+        #: users last
+        self.replays = OrderedDict()
+        #: The streams joined to each room
+        self.rooms = {}
+        self.replay_size = replay_size
+        self.replay_users = replay_users
+        self._event_ids = count(1)
+        self.keepalive = KeepaliveWheel(keepalive_interval)
+        #: Trace the delivery of the messages
+        self.trace = trace
+
+    def clear(self):
+        '''
+        Forget all the queues, streams and presence known to this process.
+        '''
+        self.store.clear()
+        self.subscriptions.clear()
+        self.usage.clear()
+        self.last_presence.clear()
+        self.last_seen.clear()
+        self.replays.clear()
+        self.rooms.clear()
+        self.keepalive.clear()
+
+    def get_usage(self, dbname):
+        '''
+        Returns the memory accounting of the database
+        '''
+        return self.usage.setdefault(dbname, Usage())
+
+    def get_metrics(self):
+        '''
+        Returns the metrics of the state of the hub in this process, by
+        database.
+        '''
+        streams = Gauge('chat_streams', 'Streams connected')
+        users = Gauge('chat_users_connected', 'Users with a stream connected')
+        depth = Gauge(
+            'chat_queue_depth_max',
+            'Messages waiting in the fullest buffer of a stream or user',
+        )
+        buffers = Gauge('chat_buffers', 'Buffers of streams and users held')
+        messages = Gauge('chat_buffered_messages', 'Messages buffered')
+        cursors = Gauge(
+            'chat_stream_cursors', 'Streams holding a cursor of the database'
+        )
+        dropped = Counter(
+            'chat_dropped_total', 'Messages dropped as the buffers were full'
+        )
+        evicted = Counter(
+            'chat_evicted_total', 'Idle queues of users evicted'
+        )
+        rooms = Gauge('chat_rooms', 'Rooms with a stream joined')
+        for dbname, usage in self.usage.items():
+            subscriptions = [
+                subscription
+                for user_subscriptions in self.subscriptions.get(
+                    dbname, {}).values()
+                for subscription in user_subscriptions
+            ]
+            labels = (dbname,)
+            streams.set(labels, len(subscriptions))
+            users.set(labels, len(self.subscriptions.get(dbname, ())))
+            depth.set(labels, max(
+                map(len, subscriptions + self.store.get(dbname, {}).values())
+                or [0]
+            ))
+            buffers.set(labels, usage['buffers'])
+            messages.set(labels, usage['messages'])
+            cursors.set(labels, usage['cursors'])
+            dropped.inc(labels, usage['dropped'])
+            evicted.inc(labels, usage['evicted'])
+            rooms.set(labels, len(self.rooms.get(dbname, ())))
+        return [
+            streams, users, depth, buffers, messages, cursors, dropped,
+            evicted, rooms,
+        ]
+
+    def get_queue(self, user, dbname=None):
+        '''
+        Return the queue of the user which holds messages until a stream of
+        the user connects.
+
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+
+        # Tryton has one python instance for several databases. So namespace
+        # the store for each database
+        users = self.store.setdefault(dbname, {})
+        if user not in users:
+            usage = self.get_usage(dbname)
+            users[user] = Buffer(self.backlog_size, self.overflow, usage)
+            usage['buffers'] += 1
+        return users[user]
+
+    def remove_queue(self, user, dbname):
+        '''
+        Remove the queue of the user and return it, if there is one.
+        '''
+        backlog = self.store.get(dbname, {}).pop(user, None)
+        if backlog is not None:
+            backlog.usage['buffers'] -= 1
+        return backlog
+
+    def evict_idle(self, now=None):
+        '''
+        Drop the queues which have not received any message within the
+        backlog TTL. The users are very likely gone and the messages stale.
+        '''
+        now = now or time.time()
+        for dbname, users in self.store.items():
+            for user, backlog in users.items():
+                if now - backlog.last_activity > self.backlog_ttl:
+                    self.remove_queue(user, dbname).clear()
+                    backlog.usage['evicted'] += 1
+
+    def presence_changed(self, user, presence, dbname=None):
+        '''
+        Returns True if the presence of the user should be broadcast, which
+        is when it differs from the last one broadcast or when that was sent
+        before the debounce window. Redundant broadcasts return False.
+
+        :param user: Id of user.
+        :param presence: The presence stanza of the user.
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+
+        now = time.time()
+        key = (dbname, user)
+        last = self.last_presence.get(key)
+        if last is not None and last[0] == presence and \
+                now - last[1] < self.presence_debounce:
+            return False
+
+        if last is None and len(self.last_presence) > 1000:
+            # Forget the broadcasts which are past the window anyway
+            for other, (_, sent) in self.last_presence.items():
+                if now - sent >= self.presence_debounce:
+                    del self.last_presence[other]
+        self.last_presence[key] = (presence, now)
+        return True
+
+    def get_subscriptions(self, user, dbname):
+        '''
+        Returns the live subscriptions of the user
+        '''
+        return self.subscriptions.get(dbname, {}).get(user, ())
+
+    def is_user_online(self, user, dbname=None):
+        '''
+        Returns True if the user has a stream connected, or had one within
+        the grace period which lets a stream reconnect without the user
+        going offline.
+
+        :param user: Id of user.
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        '''
+        return bool(self.filter_online([user], dbname))
+
+    def is_user_offline(self, user, threshold=None):
+        '''
+        Returns True if the user is not online. Kept for compatibility, the
+        threshold of the backlog is not used anymore.
+        '''
+        return not self.is_user_online(user)
+
+    def filter_online(self, users, dbname=None):
+        '''
+        Returns the set of ids of the given users who are online.
+
+        :param users: List of ids of users.
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+
+        connected = self.subscriptions.get(dbname, {})
+        last_seen = self.last_seen.get(dbname, {})
+        since = time.time() - self.presence_grace
+        return set(
+            user for user in users
+            if user in connected or last_seen.get(user, 0) > since
+        )
+
+    def user_backlog(self, user):
+        '''
+        Returns the number of messages waiting for a user to be received
+        '''
+        backlog = self.store.get(Transaction().cursor.dbname, {}).get(user)
+        return len(backlog) if backlog is not None else 0
+
+    def publish(self, user, data):
+        '''
+        Push the data to the queue of the user.
+
+        :param user: Id of user.
+        :param data: Data to publish on queue, a dictionary or a
+                     :class:`Stanza` when publishing the same data to many
+                     users.
+        '''
+        if not isinstance(data, Stanza):
+            data = Stanza(data)
+        dbname = Transaction().cursor.dbname
+        PUBLISHED.inc((dbname, data.type))
+        if self.replay_size:
+            data = self.record(dbname, user, data)
+        return self.deliver(dbname, user, data)
+
+    def publish_room(self, room, data):
+        '''
+        Push the data to the streams joined to the room, at once for all
+        the members. The members without a stream do not get it.
+
+        :param room: Id of the room.
+        :param data: Data to publish, a dictionary or a :class:`Stanza`.
+        '''
+        if not isinstance(data, Stanza):
+            data = Stanza(data)
+        dbname = Transaction().cursor.dbname
+        PUBLISHED.inc((dbname, data.type))
+        if self.replay_size:
+            data = self.keep((dbname, 'room', room), data)
+        return self.deliver_room(dbname, room, data)
+
+    def record(self, dbname, user, stanza):
+        '''
+        Number the stanza with the next event id and keep it in the replay
+        buffer of the user, which holds the last replay_size events.
+
+        :return: The :class:`Delivery` of the stanza.
+        '''
+        return self.keep((dbname, user), stanza)
+
+    def keep(self, key, stanza):
+        '''
+        Number the stanza with the next event id and keep it in the replay
+        buffer of the key, of a user or a room.
+        '''
+        delivery = Delivery(next(self._event_ids), stanza)
+        replay = self.replays.pop(key, None)
+        if replay is None:
+            replay = deque(maxlen=self.replay_size)
+        self.replays[key] = replay
+        replay.append(delivery)
+        while len(self.replays) > self.replay_users:
+            self.replays.popitem(last=False)
+        return delivery
+
+    def replay(self, user, dbname, last_event_id, rooms=()):
+        '''
+        Returns the deliveries to the user and to the rooms after the event
+        of the id, or None if that event is not kept anymore or if events
+        since may have been dropped.
+
+        :param last_event_id: The id of the last event received, as sent
+                              by the stream.
+        :param rooms: The ids of the rooms the stream joined.
+        '''
+        try:
+            last_event_id = int(last_event_id)
+        except (TypeError, ValueError):
+            return None
+        found = False
+        deliveries = []
+        keys = [(dbname, user)] + [(dbname, 'room', room) for room in rooms]
+        for key in keys:
+            replay = self.replays.get(key)
+            if not replay:
+                continue
+            if replay[0].id > last_event_id and \
+                    len(replay) == self.replay_size:
+                # The events after the last one may have been dropped
+                return None
+            for delivery in replay:
+                if delivery.id == last_event_id:
+                    found = True
+                elif delivery.id > last_event_id:
+                    deliveries.append(delivery)
+        if not found:
+            return None
+        return sorted(deliveries, key=lambda delivery: delivery.id)
+
+    def resume(self, subscription, last_event_id):
+        '''
+        Queue the events the stream missed since the last one it received
+        ahead of the messages of its subscription. If they are not all kept
+        anymore, a resync stanza is queued instead.
+        '''
+        deliveries = self.replay(
+            subscription.user, subscription.dbname, last_event_id,
+            subscription.rooms,
+        )
+        if deliveries is None:
+            subscription.prepend([resync_stanza()])
+            return
+        pending = set(
+            getattr(item, 'id', None) for item in subscription.items
+        )
+        subscription.replayed = set(delivery.id for delivery in deliveries)
+        subscription.prepend([
+            delivery for delivery in deliveries if delivery.id not in pending
+        ])
+
+    def deliver(self, dbname, user, data):
+        '''
+        Hand over the data to every stream of the user in this process, or
+        keep it in the queue of the user if no stream is connected.
+
+        :param dbname: Name of the database the user belongs to.
+        :param user: Id of user.
+        :param data: The :class:`Stanza` to deliver.
+        '''
+        if self.backlog_ttl is not None:
+            now = time.time()
+            if self._next_eviction is None or now >= self._next_eviction:
+                self.evict_idle(now)
+                self._next_eviction = now + self.backlog_ttl / 10.0
+
+        if data.type in ('join', 'leave'):
+            self.room_changed(dbname, user, data)
+        subscriptions = self.get_subscriptions(user, dbname)
+        if not subscriptions:
+            return self.get_queue(user, dbname).put(data)
+        for subscription in subscriptions:
+            subscription.put(data)
+
+    def deliver_room(self, dbname, room, data):
+        '''
+        Hand over the data to every stream joined to the room in this
+        process.
+        '''
+        for subscription in self.rooms.get(dbname, {}).get(room, ()):
+            subscription.put(data)
+
+    def room_changed(self, dbname, user, data):
+        '''
+        Join the streams of the user in this process to the room of a
+        `join` stanza, or remove them from the room of a `leave` stanza.
+        The stanza is then delivered to the user as any other.
+        '''
+        room = json.loads(data.payload)['thread']
+        for subscription in self.get_subscriptions(user, dbname):
+            if data.type == 'join':
+                self.join(subscription, {room: None})
+            else:
+                self.leave(subscription, [room])
+
+    def join(self, subscription, rooms):
+        '''
+        Join the stream to the rooms and queue the stanzas sent on join.
+
+        :param rooms: Dictionary of the ids of the rooms to the stanza sent
+                      to the stream as it joins, the roster of the room, or
+                      None.
+        '''
+        joined = self.rooms.setdefault(subscription.dbname, {})
+        for room in rooms:
+            joined.setdefault(room, set()).add(subscription)
+            subscription.rooms.add(room)
+        subscription.prepend(
+            [stanza for stanza in rooms.values() if stanza is not None]
+        )
+
+    def leave(self, subscription, rooms=None):
+        '''
+        Remove the stream from the rooms, all the rooms it joined if None.
+        '''
+        joined = self.rooms.get(subscription.dbname, {})
+        for room in list(subscription.rooms if rooms is None else rooms):
+            subscription.rooms.discard(room)
+            streams = joined.get(room)
+            if streams is None:
+                continue
+            streams.discard(subscription)
+            if not streams:
+                del joined[room]
+
+    def subscribe(self, user, dbname=None, rooms=None):
+        '''
+        Register a new stream of the user and return its subscription. The
+        messages which were waiting for the user are moved to it.
+
+        :param user: Id of user.
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        :param rooms: The rooms the stream joins, see :meth:`join`.
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+
+        usage = self.get_usage(dbname)
+        subscription = Subscription(
+            dbname, user, self.buffer_size, self.overflow, usage
+        )
+        usage['buffers'] += 1
+        users = self.subscriptions.setdefault(dbname, {})
+        if user not in users:
+            users[user] = set()
+            self.user_connected(user, dbname)
+        users[user].add(subscription)
+        self.keepalive.add(subscription)
+
+        backlog = self.remove_queue(user, dbname)
+        while backlog:
+            subscription.put(backlog.get())
+        if rooms:
+            self.join(subscription, rooms)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        '''
+        Remove the subscription of a disconnected stream and release its
+        buffer.
+        '''
+        users = self.subscriptions.get(subscription.dbname, {})
+        subscriptions = users.get(subscription.user, set())
+        self.keepalive.remove(subscription)
+        self.leave(subscription)
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+            subscription.clear()
+            subscription.usage['buffers'] -= 1
+        if not subscriptions and subscription.user in users:
+            del users[subscription.user]
+            self.user_disconnected(subscription.user, subscription.dbname)
+
+    def user_connected(self, user, dbname):
+        '''
+        Called when the first stream of the user connects to this process.
+        The live subscriptions are the registry of connections of this
+        process, so there is nothing more to do here.
+        '''
+        pass
+
+    def user_disconnected(self, user, dbname):
+        '''
+        Called when the last stream of the user in this process is closed.
+        The time is noted so that the user stays online for the grace
+        period.
+        '''
+        now = time.time()
+        last_seen = self.last_seen.setdefault(dbname, {})
+        for other, seen in last_seen.items():
+            if now - seen > self.presence_grace:
+                del last_seen[other]
+        last_seen[user] = now
+
+    def get_online_users(self, dbname=None):
+        '''
+        Returns the set of ids of the users who are online.
+
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+        return self.filter_online(
+            set(self.subscriptions.get(dbname, ())) |
+            set(self.last_seen.get(dbname, ())),
+            dbname
+        )
+
+    def listen(self, user, dbname=None, last_event_id=None, rooms=None,
+               subscription=None):
+        '''
+        Listen to messages of the user and yield the :class:`Stanza`
+        whenever something is there
+
+        :param user: Id of user.
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        :param last_event_id: The id of the last event received by the
+                              stream if it is reconnecting.
+        :param rooms: The rooms the stream joins, see :meth:`join`.
+        :param subscription: The subscription of the stream if it was made
+                             beforehand with :meth:`subscribe`, which is
+                             then released with the stream.
+        '''
+        if subscription is None:
+            subscription = self.subscribe(user, dbname, rooms)
+        try:
+            if last_event_id and self.replay_size:
+                self.resume(subscription, last_event_id)
+            while True:
+                try:
+                    yield subscription.get()
+                except queue.Empty:
+                    yield KEEPALIVE
+        finally:
+            self.unsubscribe(subscription)
+
+    def listen_batches(
+            self, user, dbname=None, last_event_id=None, rooms=None,
+            subscription=None):
+        '''
+        Listen to messages of the user and yield lists of all the
+        :class:`Stanza` which are ready, at most batch_size of them. Once a
+        stanza is there, up to batch_latency seconds are spent waiting for
+        more to make the batch. An empty list is yielded when there is
+        nothing to receive.
+
+        :param user: Id of user.
+        :param dbname: Optionally specify the dbname, if the transaction
+                       context is not available
+        :param last_event_id: The id of the last event received by the
+                              stream if it is reconnecting.
+        :param rooms: The rooms the stream joins, see :meth:`join`.
+        :param subscription: The subscription of the stream if it was made
+                             beforehand with :meth:`subscribe`, which is
+                             then released with the stream.
+        '''
+        if subscription is None:
+            subscription = self.subscribe(user, dbname, rooms)
+        try:
+            if last_event_id and self.replay_size:
+                self.resume(subscription, last_event_id)
+            while True:
+                try:
+                    batch = [subscription.get()]
+                except queue.Empty:
+                    yield []
+                    continue
+                if self.batch_latency and \
+                        len(subscription) + 1 < self.batch_size:
+                    gevent.sleep(self.batch_latency)
+                batch.extend(subscription.drain(self.batch_size - 1))
+                yield batch
+        finally:
+            self.unsubscribe(subscription)
+
+
+#: Adds the stanza to the replay stream of the user or the room, numbered
+#: by the counter of the database, and publishes it with the id of the entry
+RECORD_SCRIPT = """
+local id = redis.call(
+    'XADD', KEYS[1], 'MAXLEN', '~', ARGV[1],
+    redis.call('INCR', KEYS[3]) .. '-0',
+    'type', ARGV[3], 'payload', ARGV[4]
+)
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+redis.call(
+    'PUBLISH', KEYS[2], ARGV[3] .. ' ' .. id .. ' ' .. ARGV[5] .. ARGV[4]
+)
+return id
+"""
+
+
+class RedisMessageQueue(RedisMixin, MessageQueue):
+    '''
+    A message queue which publishes over redis pub/sub, so that messages
+    reach the listeners connected to any worker process or node.
+
+    Every worker holds a single subscriber connection which is subscribed
+    to the channels of the users and rooms with a stream in that worker,
+    and hands the messages over to their queues. A channel is subscribed
+    as its first stream connects and unsubscribed as its last one closes.
+
+    The events kept for replay are in redis streams, which need redis 5.0
+    or later. With an older server replay_size must be 0.
+    '''
+
+    def __init__(self, prefix='chat', **kwargs):
+        super(RedisMessageQueue, self).__init__(**kwargs)
+        self.prefix = prefix
+        #: The channels of the users and rooms with a stream in this worker
+        self.channels = set()
+        self._pubsub = None
+        self._subscriber = None
+        self._heartbeat = None
+        self._record = None
+
+    def get_channel(self, dbname, user):
+        '''
+        Returns the name of the redis channel of the user
+        '''
+        return '%s:%s:%s' % (self.prefix, dbname, user)
+
+    def get_replay_key(self, dbname, user):
+        '''
+        Returns the redis key of the stream of the last events of the user
+        '''
+        return '%s:replay:%s:%s' % (self.prefix, dbname, user)
+
+    def get_room_channel(self, dbname, room):
+        '''
+        Returns the name of the redis channel of the room
+        '''
+        return '%s:room:%s:%s' % (self.prefix, dbname, room)
+
+    def get_room_replay_key(self, dbname, room):
+        '''
+        Returns the redis key of the stream of the last events of the room
+        '''
+        return '%s:replay:room:%s:%s' % (self.prefix, dbname, room)
+
+    def publish(self, user, data):
+        '''
+        Publish the data to the channel of the user. The message is the type
+        of the stanza, the id of the event and the encoded stanza separated
+        by spaces, so that the subscribers need not decode it.
+
+        When the events are kept for replay, the stanza is added to the
+        redis stream of the user, whose entry id is the id of the event,
+        and published by the same script.
+
+        When the messages are traced, the encoded trace of the stanza (`-`
+        if it has none) comes before the encoded stanza, with the time it
+        is published to this user.
+
+        :param user: Id of user.
+        :param data: Data to publish on queue, a dictionary or a
+                     :class:`Stanza`.
+        '''
+        if not isinstance(data, Stanza):
+            data = Stanza(data)
+        dbname = Transaction().cursor.dbname
+        PUBLISHED.inc((dbname, data.type))
+        return self.send(
+            dbname, self.get_channel(dbname, user),
+            self.get_replay_key(dbname, user), data,
+        )
+
+    def publish_room(self, room, data):
+        '''
+        Publish the data to the channel of the room. Every worker receives
+        it on its subscriber connection, as the messages of the users, and
+        hands it to the streams joined to the room. The events of the room
+        are kept in a redis stream of their own.
+        '''
+        if not isinstance(data, Stanza):
+            data = Stanza(data)
+        dbname = Transaction().cursor.dbname
+        PUBLISHED.inc((dbname, data.type))
+        return self.send(
+            dbname, self.get_room_channel(dbname, room),
+            self.get_room_replay_key(dbname, room), data,
+        )
+
+    def get_event_id_key(self, dbname):
+        '''
+        Returns the redis key of the counter numbering the events of the
+        database. The entries of the streams of the users and the rooms
+        take their ids from it, so that the ids are unique across the
+        streams a client listens to.
+        '''
+        return '%s:event-id:%s' % (self.prefix, dbname)
+
+    def send(self, dbname, channel, replay_key, data):
+        '''
+        Publish the :class:`Stanza` on the channel, keeping it in the
+        stream of the replay key if the events are kept for replay.
+        '''
+        trace = ''
+        if self.trace:
+            if data.trace is None:
+                trace = '- '
+            else:
+                data.trace['publish'] = time.time()
+                trace = data.trace.encode() + ' '
+        if not self.replay_size:
+            return self.redis.publish(
+                channel, '%s - %s%s' % (data.type, trace, data.payload)
+            )
+        if self._record is None:
+            self._record = self.redis.register_script(RECORD_SCRIPT)
+        return self._record(
+            keys=[replay_key, channel, self.get_event_id_key(dbname)],
+            args=[
+                self.replay_size, self.backlog_ttl or 0,
+                data.type, data.payload, trace,
+            ],
+        )
+
+    def replay(self, user, dbname, last_event_id, rooms=()):
+        '''
+        Reads the events after the last one from the redis streams of the
+        user and of the rooms, with a single round trip. As the buffers of
+        the local hub, a stream whose window is full or which was trimmed
+        past the last event may have dropped events, and None is returned.
+        '''
+        keys = [self.get_replay_key(dbname, user)] + [
+            self.get_room_replay_key(dbname, room) for room in rooms
+        ]
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.xrange(key, min=last_event_id, count=self.replay_size + 1)
+            pipe.xrange(key, count=1)
+            pipe.xlen(key)
+        try:
+            results = pipe.execute()
+            last = parse_id(last_event_id)
+        except (ResponseError, ValueError):
+            # Not an id of an event
+            return None
+
+        found = False
+        deliveries = []
+        for index in range(0, len(results), 3):
+            entries, oldest, length = results[index:index + 3]
+            if len(entries) > self.replay_size:
+                # The events after the window were left out
+                return None
+            if entries and entries[0][0] == last_event_id:
+                found = True
+                entries = entries[1:]
+            elif oldest and parse_id(oldest[0][0]) > last and \
+                    length >= self.replay_size:
+                # The events after the last one may have been trimmed
+                return None
+            deliveries.extend(
+                Delivery(id, Stanza(
+                    payload=entry['payload'], type=entry['type']
+                )) for id, entry in entries
+            )
+        if not found:
+            return None
+        return sorted(
+            deliveries, key=lambda delivery: parse_id(delivery.id)
+        )
+
+    def deliver(self, dbname, user, data):
+        '''
+        The worker receives the messages of the users connected to it only
+        while they are, so nothing is kept for the users who are not
+        connected.
+        '''
+        if data.type in ('join', 'leave'):
+            self.room_changed(dbname, user, data)
+        for subscription in self.get_subscriptions(user, dbname):
+            subscription.put(data)
+
+    def get_presence_key(self, dbname):
+        '''
+        Returns the redis key of the sorted set of the users of the
+        database scored by the time they were last seen connected.
+        '''
+        return '%s:presence:%s' % (self.prefix, dbname)
+
+    def subscribe_channels(self, channels):
+        '''
+        Receive the messages of the channels on the subscriber connection.
+        If the connection is lost, the subscriber subscribes all the
+        channels again as it reconnects.
+        '''
+        channels = set(channels) - self.channels
+        self.channels.update(channels)
+        if channels and self._pubsub is not None:
+            try:
+                self._pubsub.subscribe(*channels)
+            except ConnectionError:
+                pass
+
+    def unsubscribe_channels(self, channels):
+        '''
+        Stop receiving the messages of the channels.
+        '''
+        channels = set(channels) & self.channels
+        self.channels.difference_update(channels)
+        if channels and self._pubsub is not None:
+            try:
+                self._pubsub.unsubscribe(*channels)
+            except ConnectionError:
+                pass
+
+    def join(self, subscription, rooms):
+        '''
+        Subscribe the channels of the rooms the first stream of this
+        worker joins.
+        '''
+        joined = self.rooms.get(subscription.dbname, {})
+        channels = [
+            self.get_room_channel(subscription.dbname, room)
+            for room in rooms if room not in joined
+        ]
+        super(RedisMessageQueue, self).join(subscription, rooms)
+        self.subscribe_channels(channels)
+
+    def leave(self, subscription, rooms=None):
+        '''
+        Unsubscribe the channels of the rooms the last stream of this
+        worker leaves.
+        '''
+        joined = self.rooms.get(subscription.dbname, {})
+        before = set(joined)
+        super(RedisMessageQueue, self).leave(subscription, rooms)
+        self.unsubscribe_channels([
+            self.get_room_channel(subscription.dbname, room)
+            for room in before if room not in joined
+        ])
+
+    def user_connected(self, user, dbname):
+        '''
+        Subscribe the channel of the user and mark the user as seen right
+        away instead of waiting for the next heartbeat.
+        '''
+        self.subscribe_channels([self.get_channel(dbname, user)])
+        self.redis.zadd(self.get_presence_key(dbname), {user: time.time()})
+
+    def user_disconnected(self, user, dbname):
+        '''
+        Unsubscribe the channel of the user. The user may still be
+        connected to other workers, so the user is left to go offline when
+        the heartbeats stop.
+        '''
+        self.unsubscribe_channels([self.get_channel(dbname, user)])
+
+    def heartbeat(self):
+        '''
+        Mark all the users connected to this worker as seen, and forget
+        the users not seen within the grace period.
+        '''
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for dbname, users in self.subscriptions.items():
+            key = self.get_presence_key(dbname)
+            if users:
+                pipe.zadd(key, dict.fromkeys(users, now))
+            pipe.zremrangebyscore(key, '-inf', now - self.presence_grace)
+        pipe.execute()
+
+    def run_heartbeat(self):
+        '''
+        Send the heartbeat of this worker a few times within every grace
+        period.
+        '''
+        while True:
+            gevent.sleep(self.presence_grace / 3.0)
+            try:
+                self.heartbeat()
+            except ConnectionError:
+                logger.warning('Could not send the chat presence heartbeat')
+
+    def filter_online(self, users, dbname=None):
+        '''
+        Returns the set of ids of the given users who were seen connected
+        to any of the workers within the grace period.
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+
+        users = list(users)
+        key = self.get_presence_key(dbname)
+        pipe = self.redis.pipeline(transaction=False)
+        for user in users:
+            pipe.zscore(key, user)
+        since = time.time() - self.presence_grace
+        return set(
+            user for user, seen in zip(users, pipe.execute())
+            if seen is not None and seen > since
+        )
+
+    def get_online_users(self, dbname=None):
+        '''
+        Returns the set of ids of the users who were seen connected to any
+        of the workers within the grace period.
+        '''
+        if dbname is None:
+            dbname = Transaction().cursor.dbname
+        return set(map(int, self.redis.zrangebyscore(
+            self.get_presence_key(dbname),
+            time.time() - self.presence_grace, '+inf'
+        )))
+
+    def dispatch(self, message):
+        '''
+        Deliver a message received by the subscriber connection.
+
+        :param message: The message as returned by the redis pubsub.
+        '''
+        if message['type'] != 'message':
+            return
+        channel = message['channel'][len(self.prefix) + 1:]
+        if self.trace:
+            type, event_id, trace, payload = message['data'].split(' ', 3)
+        else:
+            type, event_id, payload = message['data'].split(' ', 2)
+            trace = '-'
+        data = Stanza(payload=payload, type=type)
+        if trace != '-':
+            data.trace = Trace.decode(trace)
+        if event_id != '-':
+            data = Delivery(event_id, data)
+        if channel.startswith('room:'):
+            dbname, room = channel[len('room:'):].rsplit(':', 1)
+            self.deliver_room(dbname, room, data)
+        else:
+            dbname, user = channel.rsplit(':', 1)
+            self.deliver(dbname, int(user), data)
+
+    def run_subscriber(self):
+        '''
+        Hold the subscriber connection of this worker and dispatch the
+        messages received on it until no channel is left. The connection
+        is re-established if lost, and a message which cannot be dispatched
+        is logged and skipped, as the streams of the whole worker depend on
+        this greenlet.
+        '''
+        while self.channels:
+            pubsub = self.redis.pubsub()
+            try:
+                try:
+                    self.listen_channels(pubsub)
+                finally:
+                    self._pubsub = None
+                    pubsub.close()
+            except ConnectionError:
+                logger.warning(
+                    'Lost the chat hub subscriber connection, reconnecting'
+                )
+                gevent.sleep(1)
+
+    def listen_channels(self, pubsub):
+        '''
+        Subscribe the channels on the subscriber connection and dispatch
+        the messages received until no channel is left.
+        '''
+        pubsub.subscribe(*self.channels)
+        self._pubsub = pubsub
+        # Catch up with the streams which came or went meanwhile
+        subscribed = set(pubsub.channels)
+        if self.channels - subscribed:
+            pubsub.subscribe(*(self.channels - subscribed))
+        if subscribed - self.channels:
+            pubsub.unsubscribe(*(subscribed - self.channels))
+        for message in pubsub.listen():
+            try:
+                self.dispatch(message)
+            except Exception:
+                logger.exception(
+                    'Could not dispatch the chat message %r', message
+                )
+
+    def subscribe(self, user, dbname=None, rooms=None):
+        '''
+        Start the subscriber and the heartbeat of this worker if not running
+        and register the stream of the user.
+        '''
+        if self._subscriber is None or self._subscriber.dead:
+            self._subscriber = gevent.spawn(self.run_subscriber)
+        if self._heartbeat is None or self._heartbeat.dead:
+            self._heartbeat = gevent.spawn(self.run_heartbeat)
+        return super(RedisMessageQueue, self).subscribe(user, dbname, rooms)
+
+
+#: The hub backends which can be chosen with the `chat_hub` option of the
+#: tryton config
+BACKENDS = {
+    'local': MessageQueue,
+    'redis': RedisMessageQueue,
+}
+
+
+def get_message_queue():
+    '''
+    Returns the message queue of the backend set in the tryton config
+    '''
+    backlog_ttl = CONFIG.get('chat_backlog_ttl', 3600)
+    return BACKENDS[CONFIG.get('chat_hub', 'local')](
+        buffer_size=int(CONFIG.get('chat_buffer_size', 100)),
+        backlog_size=int(CONFIG.get('chat_backlog_size', 100)),
+        overflow=CONFIG.get('chat_overflow_policy', 'drop_oldest'),
+        backlog_ttl=int(backlog_ttl) if backlog_ttl else None,
+        presence_debounce=int(CONFIG.get('chat_presence_debounce', 60)),
+        presence_grace=int(CONFIG.get('chat_presence_grace', 30)),
+        batch_size=int(CONFIG.get('chat_batch_size', 50)),
+        batch_latency=int(CONFIG.get('chat_batch_latency', 0)) / 1000.0,
+        replay_size=int(CONFIG.get('chat_replay_size', 100)),
+        replay_users=int(CONFIG.get('chat_replay_users', 10000)),
+        keepalive_interval=int(CONFIG.get('chat_keepalive_interval', 15)),
+        trace=CONFIG.get('chat_trace', False),
+    )
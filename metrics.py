@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Counters and histograms of the chat, rendered in the text format of
+    Prometheus.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+__all__ = [
+    'Counter', 'Gauge', 'Histogram', 'Registry', 'REGISTRY', 'timed',
+    'PUBLISHED', 'PRESENCE_FANOUT', 'PRESENCE_SUPPRESSED',
+    'SEND_MESSAGE_SECONDS', 'SAVE_MESSAGE_SECONDS', 'STREAMS_OPENED',
+    'STAGE_SECONDS', 'DELIVERY_SECONDS', 'Trace',
+]
+
+#: The buckets of the histograms of durations, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+)
+
+#: The buckets of the histograms of numbers of recipients
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def format_labels(names, values):
+    '''
+    Returns the labels of a sample as written in the text format
+    '''
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+
+
+def format_value(value):
+    '''
+    Returns a value as written in the text format
+    '''
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    '''
+    A metric with a value for each combination of the values of its labels.
+
+    :param name: Name of the metric.
+    :param help: Description of the metric.
+    :param labels: Names of the labels.
+    '''
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=('dbname',)):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def clear(self):
+        '''
+        Forget all the values.
+        '''
+        self.values.clear()
+
+    def samples(self):
+        '''
+        Yields the samples of the metric as (name, labels, value) tuples,
+        labels being the text of the labels.
+        '''
+        for key, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Counter(Metric):
+    '''
+    A count which only goes up.
+    '''
+    type = 'counter'
+
+    def inc(self, labels, amount=1):
+        '''
+        Add the amount to the count of the labels.
+
+        :param labels: Tuple of the values of the labels.
+        '''
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    A value which goes up and down.
+    '''
+    type = 'gauge'
+
+    def set(self, labels, value):
+        '''
+        Set the value of the labels.
+
+        :param labels: Tuple of the values of the labels.
+        '''
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    '''
+    The distribution of the values observed, counted in buckets.
+
+    :param buckets: The upper bounds of the buckets, in increasing order.
+    '''
+    type = 'histogram'
+
+    def __init__(
+            self, name, help, labels=('dbname',), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        '''
+        Count the value in its bucket.
+
+        :param labels: Tuple of the values of the labels.
+        '''
+        counts = self.values.get(labels)
+        if counts is None:
+            # The count of each bucket, then the sum of the values
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1)
+            counts.append(0)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for key, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(
+                    self.buckets + (float('inf'),), counts[:-1]):
+                total += count
+                yield (
+                    self.name + '_bucket',
+                    format_labels(names, key + (format_value(bound),)),
+                    total,
+                )
+            labels = format_labels(self.labels, key)
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, total
+
+
+class Registry(object):
+    '''
+    The metrics of the process and the collectors which read more when the
+    metrics are rendered.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        '''
+        Add the metric and return it.
+        '''
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        '''
+        Add a function returning a list of metrics read at the time of
+        rendering.
+        '''
+        self.collectors.append(collector)
+
+    def clear(self):
+        '''
+        Forget the values of all the metrics.
+        '''
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        '''
+        Returns the metrics in the text format of Prometheus.
+        '''
+        metrics = list(self.metrics)
+        for collector in self.collectors:
+            metrics.extend(collector())
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append(
+                    '%s%s %s' % (name, labels, format_value(value))
+                )
+        return '\n'.join(lines) + '\n'
+
+
+#: The metrics of the process
+REGISTRY = Registry()
+
+PUBLISHED = REGISTRY.register(Counter(
+    'chat_published_total', 'Stanzas published to users',
+    ('dbname', 'type'),
+))
+PRESENCE_FANOUT = REGISTRY.register(Histogram(
+    'chat_presence_fanout', 'Friends a presence broadcast is sent to',
+    buckets=FANOUT_BUCKETS,
+))
+PRESENCE_SUPPRESSED = REGISTRY.register(Counter(
+    'chat_presence_suppressed_total',
+    'Presence broadcasts not sent as nothing changed',
+))
+SEND_MESSAGE_SECONDS = REGISTRY.register(Histogram(
+    'chat_send_message_seconds', 'Time to send a message',
+))
+SAVE_MESSAGE_SECONDS = REGISTRY.register(Histogram(
+    'chat_save_message_seconds', 'Time to save a message to the store',
+))
+STREAMS_OPENED = REGISTRY.register(Counter(
+    'chat_streams_opened_total', 'Streams opened, by transport',
+    ('dbname', 'transport'),
+))
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'chat_stage_seconds', 'Time traced messages spent in each stage',
+    ('dbname', 'stage'),
+))
+DELIVERY_SECONDS = REGISTRY.register(Histogram(
+    'chat_delivery_seconds',
+    'Time from accepting a traced message to writing it on a stream',
+    ('dbname', 'transport'),
+))
+
+
+class Trace(dict):
+    '''
+    The times a message reached the stages of its delivery, by stage. The
+    trace is created when the message is accepted, and each stage is
+    observed in :data:`STAGE_SECONDS` as the time since the previous one:
+
+        * `persist`: The message was saved to the message store.
+        * `presence`: The presence of the sender was broadcast.
+        * `publish`: The message was published to all the members.
+        * `dequeue`: A stream of a member took the message off its buffer.
+        * `flush`: The frame of the message was handed to the server.
+
+    The last two are observed for every stream and are not kept in the
+    trace, which is shared by all the recipients.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(Trace, self).__init__(*args, **kwargs)
+        self.setdefault('accept', time.time())
+
+    def stamp(self, dbname, stage, since):
+        '''
+        Record that the message reached the stage now.
+
+        :param since: The stage the time of this one is counted from.
+        '''
+        now = self[stage] = time.time()
+        STAGE_SECONDS.observe((dbname, stage), now - self[since])
+
+    def delivered(self, dbname, transport, dequeued):
+        '''
+        Observe the delivery of the message on a stream which took it off
+        its buffer at the time dequeued and has just written it.
+        '''
+        now = time.time()
+        if 'publish' in self:
+            STAGE_SECONDS.observe(
+                (dbname, 'dequeue'), dequeued - self['publish']
+            )
+        STAGE_SECONDS.observe((dbname, 'flush'), now - dequeued)
+        DELIVERY_SECONDS.observe((dbname, transport), now - self['accept'])
+
+    def encode(self):
+        '''
+        Returns the trace as text without spaces, to be sent along with the
+        message between processes.
+        '''
+        return ','.join(
+            '%s=%r' % (stage, stamp) for stage, stamp in self.iteritems()
+        )
+
+    @classmethod
+    def decode(cls, text):
+        '''
+        Returns the trace of the text returned by :meth:`encode`.
+        '''
+        return cls(
+            (stage, float(stamp)) for stage, stamp in (
+                item.split('=', 1) for item in text.split(',')
+            )
+        )
+
+
+@contextmanager
+def timed(histogram, labels):
+    '''
+    Observe the time spent in the block in the histogram.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe(labels, time.time() - start)
@@ -95,7 +95,7 @@ minor_version = int(minor_version)
 
 requires = [
     'gevent',
-    'redis',
+    'redis >= 3.3',
     'simplejson',
     'trytond_nereid >=3.0.7.0, <3.1',
 ]
@@ -138,6 +138,9 @@ setup(
     ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'websocket': ['gevent-websocket'],
+    },
     zip_safe=False,
     entry_points="""
     [trytond.modules]
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+    store
+
+    Persistence of the chat messages.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import atexit
+import logging
+import re
+import time
+
+import gevent
+from gevent import queue
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.pool import Pool
+
+from hub import RedisMixin
+
+__all__ = [
+    'WriteBehind', 'MessageStore', 'SQLMessageStore', 'RedisMessageStore',
+    'get_write_behind', 'get_message_store',
+]
+
+logger = logging.getLogger('nereid_chat.store')
+
+#: The ids of the entries of a redis stream
+STREAM_ID = re.compile(r'^\d+(-\d+)?$')
+
+
+class WriteBehind(object):
+    '''
+    Takes the messages to be saved off the request and writes them to the
+    database in bulk from a greenlet of its own, once batch_size messages
+    are waiting or flush_interval seconds have passed since the first.
+
+    :param maxsize: Number of messages the buffer holds. When it is full
+                    :meth:`put` waits for the writer to catch up.
+    :param batch_size: Maximum number of messages created at once.
+    :param flush_interval: Seconds a message may wait for more to come.
+    :param retries: Number of times a batch which could not be saved is
+                    tried again, before its messages are saved one by one.
+    :param retry_delay: Seconds to wait before the first retry, doubled for
+                        each of the next ones.
+    '''
+
+    def __init__(self, maxsize=10000, batch_size=100, flush_interval=1,
+                 retries=2, retry_delay=1):
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._writer = None
+        #: The messages taken off the queue by the writer and not saved yet
+        self._pending = []
+
+    def put(self, dbname, values, timeout=None):
+        '''
+        Queue the values of a message to be created.
+
+        :param dbname: Name of the database to save the message in.
+        :param values: The values to create the `nereid.chat.message` with.
+        :param timeout: Seconds to wait when the buffer is full.
+        :return: True if queued, False if the buffer stayed full.
+        '''
+        if self._writer is None or self._writer.dead:
+            self._writer = gevent.spawn(self.run)
+        try:
+            self.queue.put((dbname, values), timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def take(self):
+        '''
+        Wait for a message and return it with the ones which are waiting or
+        come within the flush interval, at most batch_size of them. They
+        are pending until written.
+        '''
+        self._pending = items = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(items) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    items.append(self.queue.get(timeout=remaining))
+                else:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def run(self):
+        '''
+        Write the messages as they come, for ever.
+        '''
+        while True:
+            self.write(self.take())
+
+    def flush(self):
+        '''
+        Write all the messages waiting in the buffer right away, with those
+        the writer took and did not save yet, once the writer is stopped.
+        '''
+        if self._writer is not None:
+            self._writer.kill()
+        items, self._pending = self._pending, []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        self.write(items)
+
+    def write(self, items):
+        '''
+        Create the messages, with a transaction for each database. A batch
+        which fails, as when the database is unavailable for a moment, is
+        tried again a few times. If it still fails, its messages are saved
+        one by one so that only the ones which cannot be saved are lost.
+        The messages of each database are removed from the items once done.
+
+        :param items: List of (dbname, values) tuples.
+        '''
+        by_database = {}
+        for dbname, values in items:
+            by_database.setdefault(dbname, []).append(values)
+
+        for dbname, vlist in by_database.iteritems():
+            for attempt in xrange(self.retries + 1):
+                try:
+                    self.create(dbname, vlist)
+                    break
+                except Exception:
+                    logger.warning(
+                        'Could not save %d chat messages in %s',
+                        len(vlist), dbname, exc_info=True
+                    )
+                    if attempt < self.retries:
+                        gevent.sleep(self.retry_delay * 2 ** attempt)
+            else:
+                for values in vlist:
+                    try:
+                        self.create(dbname, [values])
+                    except Exception:
+                        logger.exception(
+                            'Could not save a chat message in %s: %r',
+                            dbname, values
+                        )
+            items[:] = [item for item in items if item[0] != dbname]
+
+    def create(self, dbname, vlist):
+        '''
+        Create the messages of the values in the database and commit.
+        '''
+        with Transaction().start(dbname, 0):
+            Message = Pool().get('nereid.chat.message')
+            Message.create(vlist)
+            Transaction().cursor.commit()
+
+
+class MessageStore(object):
+    '''
+    The interface of the stores which keep the history of the threads.
+    '''
+
+    def append(self, chat, user, payload):
+        '''
+        Save a message of the chat.
+
+        :param chat: Browse record of the chat.
+        :param user: Browse record of the sender.
+        :param payload: The message encoded as JSON.
+        '''
+        raise NotImplementedError
+
+    def range(self, chat, before=None, limit=50):
+        '''
+        Returns the messages of the chat, the latest first, as a list of
+        (cursor, payload) tuples.
+
+        :param chat: Browse record of the chat.
+        :param before: Only return the messages older than the message of
+                       this cursor.
+        :param limit: Maximum number of messages to return.
+        :raise ValueError: If the cursor is not one of the store.
+        '''
+        raise NotImplementedError
+
+
+class SQLMessageStore(MessageStore):
+    '''
+    Keeps the messages as `nereid.chat.message` records in the database.
+    The cursors are the ids of the records.
+
+    :param write_behind: The :class:`WriteBehind` buffer to save the
+                         messages with, if any.
+    '''
+
+    def __init__(self, write_behind=None):
+        self.write_behind = write_behind
+
+    def append(self, chat, user, payload):
+        '''
+        Creates the message and returns the record. If the write behind
+        buffer is used the message is queued to be saved in bulk later and
+        None is returned. When the buffer is full the message is saved right
+        away.
+        '''
+        Message = Pool().get('nereid.chat.message')
+
+        values = {
+            'chat': chat.id,
+            'message': payload,
+            'user': user.id
+        }
+        if self.write_behind is not None and self.write_behind.put(
+                Transaction().cursor.dbname, values, timeout=1):
+            return None
+        return Message.create([values])[0]
+
+    def range(self, chat, before=None, limit=50):
+        '''
+        The messages are read with a single query on the table, ordered by
+        the creation date and the id, and the page starts right after the
+        message of the cursor.
+        '''
+        Message = Pool().get('nereid.chat.message')
+        message = Message.__table__()
+        cursor = Transaction().cursor
+
+        where = message.chat == chat.id
+        if before is not None:
+            before = int(before)
+            last = Message.__table__()
+            last_date = last.select(
+                last.create_date, where=last.id == before
+            )
+            where &= (message.create_date < last_date) | (
+                (message.create_date == last_date) &
+                (message.id < before)
+            )
+        cursor.execute(*message.select(
+            message.id, message.message,
+            where=where,
+            order_by=[message.create_date.desc, message.id.desc],
+            limit=limit,
+        ))
+        return [(str(id), payload) for id, payload in cursor.fetchall()]
+
+
+class RedisMessageStore(RedisMixin, MessageStore):
+    '''
+    Keeps the messages in a redis stream for each thread, trimmed to about
+    maxlen messages. The cursors are the ids of the stream entries.
+
+    :param maxlen: Number of messages kept for each thread, None to keep
+                   all of them.
+    '''
+
+    def __init__(self, maxlen=None, prefix='chat'):
+        self.maxlen = maxlen
+        self.prefix = prefix
+
+    def get_key(self, chat):
+        '''
+        Returns the redis key of the stream of the thread of the chat
+        '''
+        return '%s:history:%s:%s' % (
+            self.prefix, Transaction().cursor.dbname, chat.thread
+        )
+
+    def append(self, chat, user, payload):
+        '''
+        Adds the message to the stream of the thread and returns the id of
+        the entry.
+        '''
+        return self.redis.xadd(
+            self.get_key(chat), {'user': user.id, 'message': payload},
+            maxlen=self.maxlen, approximate=True,
+        )
+
+    def range(self, chat, before=None, limit=50):
+        if before is not None and not STREAM_ID.match(before):
+            raise ValueError('Invalid stream id %r' % before)
+        if before is None:
+            entries = self.redis.xrevrange(
+                self.get_key(chat), count=limit
+            )
+        else:
+            # The range is inclusive, so fetch one more and skip the entry
+            # of the cursor.
+            entries = self.redis.xrevrange(
+                self.get_key(chat), max=before, count=limit + 1
+            )
+            entries = [
+                entry for entry in entries if entry[0] != before
+            ][:limit]
+        return [(id, fields['message']) for id, fields in entries]
+
+
+#: The message stores which can be chosen with the `chat_message_store`
+#: option of the tryton config
+BACKENDS = {
+    'sql': SQLMessageStore,
+    'redis': RedisMessageStore,
+}
+
+
+def get_write_behind():
+    '''
+    Returns the write behind buffer if enabled in the tryton config, else
+    None. The buffer is flushed when the process exits.
+    '''
+    if not CONFIG.get('chat_write_behind'):
+        return None
+    write_behind = WriteBehind(
+        maxsize=int(CONFIG.get('chat_write_behind_size', 10000)),
+        batch_size=int(CONFIG.get('chat_write_behind_batch', 100)),
+        flush_interval=int(
+            CONFIG.get('chat_write_behind_interval', 1000)
+        ) / 1000.0,
+    )
+    atexit.register(write_behind.flush)
+    return write_behind
+
+
+def get_message_store():
+    '''
+    Returns the message store of the backend set in the tryton config
+    '''
+    backend = CONFIG.get('chat_message_store', 'sql')
+    if backend == 'sql':
+        return SQLMessageStore(write_behind=get_write_behind())
+    maxlen = CONFIG.get('chat_history_maxlen')
+    return BACKENDS[backend](maxlen=int(maxlen) if maxlen else None)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_chat
+
+    Microbenchmarks of the hot paths of the chat: publishing to and
+    listening on the hub, the presence fan-out, the serialization of the
+    users and the encoding of the event stream frames. They run on the
+    database of the tests with the redis of :class:`fake_redis.FakeRedis`.
+
+    Usage::
+
+        python tests/bench_chat.py --save tests/benchmarks/baseline.json
+        python tests/bench_chat.py --compare tests/benchmarks/baseline.json
+
+    Each benchmark is repeated and the best time of an operation is kept,
+    as :mod:`timeit` does, along with the median. With `--compare` the
+    results are reported against the baseline, and the command fails if a
+    benchmark got slower by more than the threshold.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+
+#: The benchmarks, in the order they are run
+BENCHMARKS = []
+
+#: Number of stanzas a run of the hub benchmarks handles
+STANZAS = 100
+
+
+def benchmark(function):
+    '''
+    Register the benchmark. The function is given the :class:`Fixture` and
+    returns the function timed and the number of operations it does.
+    '''
+    BENCHMARKS.append(function)
+    return function
+
+
+class Fixture(object):
+    '''
+    The records and the hub the benchmarks run on.
+
+    :param friends: Number of friends online for the presence fan-out.
+    '''
+
+    def __init__(self, friends):
+        from trytond.pool import Pool
+        from trytond.transaction import Transaction
+        from trytond.modules.nereid_chat.chat import MQ
+        from trytond.modules.nereid_chat.hub import Stanza
+
+        self.MQ = MQ
+        self.Stanza = Stanza
+        self.dbname = Transaction().cursor.dbname
+        self.NereidUser = Pool().get('nereid.user')
+        self.Chat = Pool().get('nereid.chat')
+        self.users = self.NereidUser.search([])
+        self.user = self.users[0]
+        self.friends = self.users[1:friends + 1]
+
+    def stanzas(self):
+        '''
+        Returns STANZAS message stanzas as the hub delivers them
+        '''
+        return [
+            self.MQ.record(self.dbname, self.user.id, self.Stanza({
+                'type': 'message',
+                'message': {'text': 'Hello %d' % index},
+            })) for index in xrange(STANZAS)
+        ]
+
+
+@benchmark
+def hub_publish(fixture):
+    '''
+    Publish a stanza to a user with a stream
+    '''
+    MQ, user = fixture.MQ, fixture.user.id
+    subscription = MQ.subscribe(user, fixture.dbname)
+    stanza = fixture.Stanza({'type': 'message', 'message': {'text': 'Hi'}})
+
+    def run():
+        for _ in xrange(STANZAS):
+            MQ.publish(user, stanza)
+        subscription.clear()
+    return run, STANZAS
+
+
+@benchmark
+def hub_listen(fixture):
+    '''
+    Take a stanza off the stream of a user
+    '''
+    stanzas = fixture.stanzas()
+    listener = fixture.MQ.listen(fixture.user.id, fixture.dbname)
+    # Subscribe
+    fixture.MQ.publish(fixture.user.id, {'type': 'presence'})
+    next(listener)
+    subscription, = fixture.MQ.get_subscriptions(
+        fixture.user.id, fixture.dbname
+    )
+
+    def run():
+        subscription.prepend(stanzas)
+        for _ in xrange(STANZAS):
+            next(listener)
+    return run, STANZAS
+
+
+@benchmark
+def presence_fanout(fixture):
+    '''
+    Broadcast the presence of a user to the friends online
+    '''
+    subscriptions = [
+        fixture.MQ.subscribe(friend.id, fixture.dbname)
+        for friend in fixture.friends
+    ]
+
+    def run():
+        fixture.user.broadcast_presence(force=True)
+        for subscription in subscriptions:
+            subscription.clear()
+    return run, 1
+
+
+@benchmark
+def user_serialize(fixture):
+    '''
+    Serialize a user
+    '''
+    NereidUser, id = fixture.NereidUser, fixture.user.id
+
+    def run():
+        NereidUser(id).serialize()
+    return run, 1
+
+
+@benchmark
+def user_get_serialized(fixture):
+    '''
+    Get the serialized members of a thread of two from the user cache
+    '''
+    NereidUser = fixture.NereidUser
+    ids = [fixture.user.id, fixture.friends[0].id]
+
+    def run():
+        NereidUser.get_serialized(ids)
+    return run, 1
+
+
+@benchmark
+def sse_frames(fixture):
+    '''
+    Encode the frame of a stanza on the event stream
+    '''
+    return stream_frames(fixture, False)
+
+
+@benchmark
+def sse_batch_frames(fixture):
+    '''
+    Encode a stanza in a batch frame on the event stream
+    '''
+    return stream_frames(fixture, True)
+
+
+def stream_frames(fixture, batch):
+    '''
+    Returns the function reading the frames of STANZAS stanzas from the
+    event stream of a user.
+    '''
+    MQ = fixture.MQ
+    stanzas = fixture.stanzas()
+    stream = fixture.Chat.generate_event_stream(
+        fixture.user.id, fixture.dbname, batch
+    )
+    # Subscribe
+    MQ.publish(fixture.user.id, {'type': 'presence'})
+    next(stream)
+    subscription, = MQ.get_subscriptions(fixture.user.id, fixture.dbname)
+
+    def run():
+        subscription.prepend(stanzas)
+        while len(subscription):
+            next(stream)
+    return run, STANZAS
+
+
+def measure(run, ops, repeat=5, min_time=0.2):
+    '''
+    Returns the best and the median seconds an operation of the function
+    takes, running it enough times for each repeat to last min_time.
+    '''
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            run()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number = max(
+            number * 2, int(number * min_time / max(elapsed, 1e-6))
+        )
+
+    timings = [elapsed]
+    for _ in xrange(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            run()
+        timings.append(time.time() - start)
+    timings = sorted(timing / number / ops for timing in timings)
+    return timings[0], timings[len(timings) // 2]
+
+
+def run_benchmarks(names=None, friends=100, repeat=5):
+    '''
+    Run the benchmarks, or the ones of the names, each with a clean hub,
+    and return the results.
+    '''
+    from trytond.modules.nereid_chat.chat import MQ, USER_CACHE
+
+    fixture = Fixture(friends)
+    results = {}
+    for function in BENCHMARKS:
+        if names and function.__name__ not in names:
+            continue
+        MQ.clear()
+        USER_CACHE.clear()
+        best, median = measure(*function(fixture), repeat=repeat)
+        results[function.__name__] = {
+            'description': function.__doc__.strip(),
+            'best_us': best * 1e6,
+            'median_us': median * 1e6,
+        }
+    MQ.clear()
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'friends': friends,
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, results, threshold=25):
+    '''
+    Returns the lines of the report of the results against the baseline
+    and whether a benchmark is slower by more than threshold percent.
+    '''
+    lines = ['%-22s %12s %12s %8s' % (
+        'benchmark', 'baseline us', 'current us', 'change'
+    )]
+    regressed = False
+    for name, result in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            lines.append('%-22s %12s %12.2f %8s' % (
+                name, '-', result['best_us'], 'new'
+            ))
+            continue
+        change = (result['best_us'] / base['best_us'] - 1) * 100
+        flag = ''
+        if change > threshold:
+            flag = ' slower'
+            regressed = True
+        elif change < -threshold:
+            flag = ' faster'
+        lines.append('%-22s %12.2f %12.2f %+7.1f%%%s' % (
+            name, base['best_us'], result['best_us'], change, flag
+        ))
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks of the chat'
+    )
+    parser.add_argument(
+        'names', nargs='*', help='The benchmarks to run, all by default'
+    )
+    parser.add_argument(
+        '--friends', type=int, default=100,
+        help='Number of friends online for the presence fan-out'
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help='Save the results as JSON to a file')
+    parser.add_argument(
+        '--compare', help='Compare the results to a baseline JSON file'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=25,
+        help='Percent slower than the baseline which fails the comparison'
+    )
+    options = parser.parse_args(argv)
+
+    from fake_redis import FakeRedis
+    from trytond.modules.nereid_chat import chat as chat_module, hub
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT, POOL
+    from trytond.transaction import Transaction
+    from test_chat import TestChat
+
+    hub._redis_client = FakeRedis()
+    # The test database is in memory, the cursor is kept by the streams
+    chat_module.DETACH_STREAMS = False
+
+    case = TestChat('setup_defaults')
+    case.setUp()
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        data = case.setup_defaults()
+        POOL.get('nereid.user').create([{
+            'party': data['test_party'],
+            'display_name': 'User %d' % index,
+            'email': 'user%d@openlabs.co.in' % index,
+            'company': data['company'],
+        } for index in xrange(options.friends + 1)])
+        results = run_benchmarks(
+            options.names, options.friends, options.repeat
+        )
+
+    if options.save:
+        with open(options.save, 'w') as baseline:
+            json.dump(
+                results, baseline, indent=4, sort_keys=True,
+                separators=(',', ': '),
+            )
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            lines, regressed = compare(
+                json.load(baseline), results, options.threshold
+            )
+        print '\n'.join(lines)
+        return 1 if regressed else 0
+
+    for name, result in sorted(results['benchmarks'].items()):
+        print '%-22s %10.2f us (median %.2f us)  %s' % (
+            name, result['best_us'], result['median_us'],
+            result['description'],
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
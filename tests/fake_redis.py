@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+    fake_redis
+
+    A redis client which keeps the data in the process, with just the
+    commands the chat uses, so that the load tests need no redis server.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from fnmatch import fnmatchcase
+from itertools import count
+
+from gevent import queue
+from redis import ResponseError
+
+from trytond.modules.nereid_chat.hub import RECORD_SCRIPT
+
+__all__ = ['FakeRedis']
+
+
+def parse_id(id):
+    '''
+    Returns the id of a stream entry as a tuple to compare, with the
+    special ids `-` and `+`.
+    '''
+    if id == '-':
+        return (0, 0)
+    if id == '+':
+        return (float('inf'), float('inf'))
+    try:
+        ms, _, seq = str(id).partition('-')
+        return (int(ms), int(seq or 0))
+    except ValueError:
+        raise ResponseError('Invalid stream ID specified as stream command')
+
+
+class FakePubSub(object):
+    '''
+    The subscriber connection, with channel subscriptions only.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = {}
+        self.messages = queue.Queue()
+
+    @property
+    def subscribed(self):
+        return bool(self.channels)
+
+    def subscribe(self, *channels):
+        self.client.subscribers.add(self)
+        for channel in channels:
+            self.channels[channel] = None
+            self.messages.put({
+                'type': 'subscribe', 'pattern': None,
+                'channel': channel, 'data': len(self.channels),
+            })
+
+    def unsubscribe(self, *channels):
+        for channel in channels:
+            self.channels.pop(channel, None)
+            self.messages.put({
+                'type': 'unsubscribe', 'pattern': None,
+                'channel': channel, 'data': len(self.channels),
+            })
+
+    def close(self):
+        self.channels.clear()
+        self.client.subscribers.discard(self)
+
+    def receive(self, channel, data):
+        '''
+        Queue the message if the channel is subscribed and return the
+        number of subscribers reached.
+        '''
+        if channel not in self.channels:
+            return 0
+        self.messages.put({
+            'type': 'message', 'pattern': None,
+            'channel': channel, 'data': data,
+        })
+        return 1
+
+    def listen(self):
+        while self.subscribed:
+            yield self.messages.get()
+
+
+class FakePipeline(object):
+    '''
+    Queues the commands and runs them on execute.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [
+            getattr(self.client, name)(*args, **kwargs)
+            for name, args, kwargs in commands
+        ]
+
+
+def record(client, keys, args):
+    '''
+    Does what :data:`hub.RECORD_SCRIPT` does.
+    '''
+    maxlen, ttl, type, payload = args[:4]
+    head = args[4] if len(args) > 4 else ''
+    id = client.xadd(
+        keys[0], {'type': type, 'payload': payload},
+        id='%d-0' % client.incr(keys[2]), maxlen=int(maxlen),
+    )
+    if int(ttl) > 0:
+        client.expire(keys[0], ttl)
+    client.publish(keys[1], '%s %s %s%s' % (type, id, head, payload))
+    return id
+
+
+class FakeRedis(object):
+    '''
+    The data is kept in a dictionary by key, strings as str, sorted sets as
+    dictionaries of scores and streams as lists of (id, fields) tuples.
+    The scripts are those of the chat, run by their python counterparts.
+    '''
+    #: The python functions run for the lua scripts
+    scripts = {
+        RECORD_SCRIPT: record,
+    }
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = set()
+        self._sequence = count(1)
+
+    def _get(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires < time.time():
+            self.delete(key)
+        return self.data.get(key)
+
+    def flushdb(self):
+        self.data.clear()
+        self.expires.clear()
+
+    def get(self, key):
+        return self._get(key)
+
+    def mget(self, keys):
+        return map(self._get, keys)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value)
+        self.expires.pop(key, None)
+        if ex is not None:
+            self.expire(key, ex)
+        return True
+
+    def expire(self, key, seconds):
+        if key not in self.data:
+            return False
+        self.expires[key] = time.time() + int(seconds)
+        return True
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            self.expires.pop(key, None)
+            if self.data.pop(key, None) is not None:
+                deleted += 1
+        return deleted
+
+    def scan_iter(self, match='*'):
+        return [
+            key for key in list(self.data) if fnmatchcase(key, match) and
+            self._get(key) is not None
+        ]
+
+    def publish(self, channel, data):
+        return sum(
+            subscriber.receive(channel, data)
+            for subscriber in list(self.subscribers)
+        )
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        function = self.scripts[script]
+
+        def run(keys=(), args=()):
+            return function(self, keys, [str(arg) for arg in args])
+        return run
+
+    def zadd(self, key, mapping):
+        scores = self.data.setdefault(key, {})
+        mapping = dict(
+            (str(member), float(score)) for member, score in mapping.items()
+        )
+        added = len(set(mapping) - set(scores))
+        scores.update(mapping)
+        return added
+
+    def zscore(self, key, member):
+        return (self._get(key) or {}).get(str(member))
+
+    def zrangebyscore(self, key, min, max):
+        min, max = float(min), float(max)
+        return [
+            member for member, score in sorted(
+                (self._get(key) or {}).items(), key=lambda item: item[1]
+            ) if min <= score <= max
+        ]
+
+    def zremrangebyscore(self, key, min, max):
+        scores = self._get(key) or {}
+        members = self.zrangebyscore(key, min, max)
+        for member in members:
+            del scores[member]
+        return len(members)
+
+    def incr(self, key):
+        self.data[key] = str(int(self._get(key) or 0) + 1)
+        return int(self.data[key])
+
+    def xadd(self, key, fields, id='*', maxlen=None, approximate=True):
+        entries = self.data.setdefault(key, [])
+        if id == '*':
+            id = '%d-%d' % (int(time.time() * 1000), next(self._sequence))
+        elif entries and parse_id(id) <= parse_id(entries[-1][0]):
+            raise ResponseError(
+                'The ID specified in XADD is equal or smaller than the '
+                'target stream top item'
+            )
+        entries.append(
+            (id, dict((k, str(v)) for k, v in fields.items()))
+        )
+        if maxlen is not None and len(entries) > maxlen:
+            del entries[:len(entries) - maxlen]
+        return id
+
+    def xlen(self, key):
+        return len(self._get(key) or [])
+
+    def xrange(self, key, min='-', max='+', count=None):
+        min, max = parse_id(min), parse_id(max)
+        entries = [
+            entry for entry in self._get(key) or []
+            if min <= parse_id(entry[0]) <= max
+        ]
+        return entries[:count] if count is not None else entries
+
+    def xrevrange(self, key, max='+', min='-', count=None):
+        min, max = parse_id(min), parse_id(max)
+        entries = [
+            entry for entry in reversed(self._get(key) or [])
+            if min <= parse_id(entry[0]) <= max
+        ]
+        return entries[:count] if count is not None else entries
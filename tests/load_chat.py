@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+    load_chat
+
+    A load test of the chat. The nereid application is driven in the
+    process by simulated users: every user logs in, starts a session with
+    a friend, listens to its event stream and the users send messages at
+    the given rate. The redis server is replaced by a
+    :class:`fake_redis.FakeRedis`, and the database is the one of the
+    tests.
+
+    Usage::
+
+        python tests/load_chat.py --users 1000 --rate 200 --duration 30
+
+    The throughput, the peak memory of the process and the latencies of
+    sending a message and from sending it to receiving it on the stream of
+    the friend are reported at the end, as JSON with `--json`.
+
+    All the users share the transaction of the test, which is safe as the
+    greenlets only switch while waiting on the hub.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import json
+import random
+import resource
+import sys
+import time
+
+import gevent
+from gevent.pool import Pool as GreenletPool
+from trytond.config import CONFIG
+
+
+def percentile(values, percent):
+    '''
+    Returns the percentile of the values, None if there is none.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * percent / 100.0))]
+
+
+def milliseconds(value):
+    return value * 1000 if value is not None else None
+
+
+def max_rss():
+    '''
+    Returns the peak memory of the process in bytes
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SimulatedUser(object):
+    '''
+    A user of the chat with a client of its own, which keeps the session.
+
+    :param load: The :class:`ChatLoad` the user belongs to.
+    :param user: Browse record of the nereid user.
+    '''
+
+    def __init__(self, load, user):
+        self.load = load
+        self.user = user
+        self.client = load.app.test_client()
+        self.thread_id = None
+
+    def login(self):
+        rv = self.client.post('/login', data={
+            'email': self.user.email,
+            'password': 'password',
+        })
+        assert rv.status_code == 302, 'Could not log in %s' % self.user.email
+
+    def start_session(self, friend):
+        '''
+        Start the session with the friend, whose thread the messages are
+        sent to.
+        '''
+        rv = self.client.post('/nereid-chat/start-session', data={
+            'user': friend.user.id,
+        })
+        assert rv.status_code == 200, rv.data
+        self.thread_id = json.loads(rv.data)['thread_id']
+
+    def listen(self):
+        '''
+        Read the event stream for ever and count the messages received,
+        with the time since they were sent.
+        '''
+        rv = self.client.get(
+            '/nereid-chat/stream?batch=%d' % self.load.batch,
+            buffered=False,
+        )
+        for frame in rv.response:
+            if '"message"' not in frame:
+                continue
+            now = time.time()
+            for line in frame.splitlines():
+                if not line.startswith('data: '):
+                    continue
+                data = json.loads(line[len('data: '):])
+                for stanza in data.get('stanzas', [data]):
+                    if stanza['type'] == 'message':
+                        self.load.received(
+                            now - float(stanza['message']['text'])
+                        )
+
+    def send(self):
+        '''
+        Send a message with the time it is sent as text.
+        '''
+        start = time.time()
+        rv = self.client.post('/nereid-chat/send-message', data={
+            'thread_id': self.thread_id,
+            'message': repr(start),
+        })
+        self.load.sent(rv.status_code == 200, time.time() - start)
+
+
+class ChatLoad(object):
+    '''
+    Runs the load on the application with the users.
+
+    :param users: Number of users, paired in threads of two.
+    :param rate: Messages sent per second by all the users.
+    :param duration: Seconds the messages are sent for.
+    :param concurrency: Maximum number of messages being sent at once.
+    :param batch: If True, the streams receive the stanzas in batches.
+    '''
+
+    def __init__(self, app, users, rate, duration, concurrency=50,
+                 batch=False):
+        self.app = app
+        self.users = [SimulatedUser(self, user) for user in users]
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.batch = int(batch)
+        self.send_latencies = []
+        self.failed = 0
+        self.latencies = []
+
+    def sent(self, success, latency):
+        if success:
+            self.send_latencies.append(latency)
+        else:
+            self.failed += 1
+
+    def received(self, latency):
+        self.latencies.append(latency)
+
+    def connect(self):
+        '''
+        Log the users in, start the sessions of every pair of users and
+        open their streams.
+        '''
+        for user in self.users:
+            user.login()
+        for index, user in enumerate(self.users):
+            user.start_session(self.users[index ^ 1])
+        listeners = [gevent.spawn(user.listen) for user in self.users]
+        # Let the streams subscribe
+        gevent.sleep(0.1)
+        return listeners
+
+    def send(self):
+        '''
+        Send messages from random users at the rate for the duration.
+        '''
+        pool = GreenletPool(self.concurrency)
+        interval = 1.0 / self.rate
+        start = next_send = time.time()
+        while next_send < start + self.duration:
+            pool.spawn(random.choice(self.users).send)
+            next_send += interval
+            gevent.sleep(max(0, next_send - time.time()))
+        pool.join()
+
+    def run(self, drain=2):
+        '''
+        Run the load and return the report.
+
+        :param drain: Seconds to wait for the deliveries after the last
+                      message is sent.
+        '''
+        memory = max_rss()
+        start = time.time()
+        listeners = self.connect()
+        connected = time.time()
+        self.send()
+        sent = time.time()
+        expected = len(self.send_latencies) * 2
+        deadline = sent + drain
+        while len(self.latencies) < expected and time.time() < deadline:
+            gevent.sleep(0.05)
+        gevent.killall(listeners)
+        return self.report(connected - start, sent - connected, memory)
+
+    def report(self, connect_time, send_time, memory):
+        return {
+            'users': len(self.users),
+            'connect_seconds': connect_time,
+            'sent': len(self.send_latencies),
+            'failed': self.failed,
+            'sent_per_second': len(self.send_latencies) / send_time,
+            'expected': len(self.send_latencies) * 2,
+            'received': len(self.latencies),
+            'received_per_second': len(self.latencies) / send_time,
+            'send_ms_p50': milliseconds(percentile(self.send_latencies, 50)),
+            'send_ms_p99': milliseconds(percentile(self.send_latencies, 99)),
+            'latency_ms_p50': milliseconds(percentile(self.latencies, 50)),
+            'latency_ms_p99': milliseconds(percentile(self.latencies, 99)),
+            'max_rss_mb': max_rss() / 1024.0 / 1024,
+            'rss_growth_mb': (max_rss() - memory) / 1024.0 / 1024,
+        }
+
+
+def print_report(report):
+    '''
+    Print the report for humans.
+    '''
+    print 'users            %(users)d, connected in %(connect_seconds).1fs' \
+        % report
+    print 'messages sent    %(sent)d (%(sent_per_second).1f/s), ' \
+        '%(failed)d failed' % report
+    print 'messages         %(received)d received of %(expected)d ' \
+        '(%(received_per_second).1f/s)' % report
+    for name, key in [('send', 'send_ms'), ('send-to-receive', 'latency_ms')]:
+        print '%-16s p50 %s ms, p99 %s ms' % ((name, ) + tuple(
+            '%.1f' % report[key + suffix]
+            if report[key + suffix] is not None else '-'
+            for suffix in ('_p50', '_p99')
+        ))
+    print 'memory           %(max_rss_mb).1f MB max rss, ' \
+        '%(rss_growth_mb).1f MB more' % report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the chat')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument(
+        '--rate', type=float, default=100,
+        help='Messages sent per second by all the users'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='Seconds to send messages for'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=50,
+        help='Maximum number of messages being sent at once'
+    )
+    parser.add_argument('--hub', choices=['local', 'redis'], default='local')
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument(
+        '--json', action='store_true', help='Print the report as JSON'
+    )
+    options = parser.parse_args(argv)
+
+    # The hub is created when the module is imported
+    CONFIG['chat_hub'] = options.hub
+
+    from fake_redis import FakeRedis
+    from trytond.modules.nereid_chat import chat as chat_module, hub
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT, POOL
+    from trytond.transaction import Transaction
+    from test_chat import TestChat
+
+    hub._redis_client = FakeRedis()
+    # The test database is in memory, the cursor is kept by the streams
+    chat_module.DETACH_STREAMS = False
+
+    case = TestChat('setup_defaults')
+    case.setUp()
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        data = case.setup_defaults()
+        app = case.get_app()
+        app.redis_client = hub._redis_client
+        users = POOL.get('nereid.user').create([{
+            'party': data['test_party'],
+            'display_name': 'User %d' % index,
+            'email': 'user%d@openlabs.co.in' % index,
+            'password': 'password',
+            'company': data['company'],
+        } for index in xrange(options.users + options.users % 2)])
+
+        report = ChatLoad(
+            app, users, options.rate, options.duration,
+            options.concurrency, options.batch,
+        ).run()
+
+    if options.json:
+        print json.dumps(report, indent=4, sort_keys=True)
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
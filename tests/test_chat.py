@@ -11,19 +11,40 @@ import os
 import sys
 import uuid
 import json
+import time
+from contextlib import contextmanager
 DIR = os.path.abspath(os.path.normpath(os.path.join(
     __file__, '..', '..', '..', '..', '..', 'trytond')))
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
 import unittest
+import gevent
+from gevent import queue
 from redis import Redis
+from sql.aggregate import Max
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
+from trytond.model import ModelSQL
 
 from nereid.testing import NereidTestCase
 
+from trytond.modules.nereid_chat import chat as chat_module
+from trytond.modules.nereid_chat.chat import MQ, THREAD_CACHE, \
+    USER_CACHE, ROOM_CACHE, TOKEN_CACHE, stream_cursor, stanza_cursor
+from trytond.modules.nereid_chat.store import WriteBehind, \
+    SQLMessageStore, RedisMessageStore
+from trytond.modules.nereid_chat.hub import Stanza, MessageQueue, \
+    RedisMessageQueue, batch_frame, get_redis_client
+from trytond.modules.nereid_chat.cache import LRUCache, RedisCache, \
+    get_thread_cache
+from trytond.modules.nereid_chat.metrics import REGISTRY, STAGE_SECONDS, \
+    DELIVERY_SECONDS, PUBLISHED, Trace
+from trytond.config import CONFIG
+
+from fake_redis import FakeRedis
+
 
 class TestChat(NereidTestCase):
     "Test the chat system"
@@ -37,13 +58,20 @@ class TestChat(NereidTestCase):
         self.Language = POOL.get('ir.lang')
         self.NereidUser = POOL.get('nereid.user')
         self.Chat = POOL.get('nereid.chat')
+        self.ChatMember = POOL.get('nereid.chat.member')
         self.Party = POOL.get('party.party')
         self.Locale = POOL.get('nereid.website.locale')
         self.templates = {
             'localhost/login.jinja':
             '{{ login_form.errors }}{{ get_flashed_messages()|safe }}',
         }
-        Redis().flushdb()
+        get_redis_client().flushdb()
+        MQ.clear()
+        THREAD_CACHE.clear()
+        USER_CACHE.clear()
+        ROOM_CACHE.clear()
+        TOKEN_CACHE.clear()
+        REGISTRY.clear()
 
     def setup_defaults(self):
         currency, = self.Currency.create([{
@@ -98,6 +126,29 @@ class TestChat(NereidTestCase):
             'test_party': test_party,
         }
 
+    @contextmanager
+    def committed(self):
+        '''
+        Let the block commit the transaction of the test, as the detached
+        streams do, and delete the records created in it afterwards since
+        the database is shared by the tests.
+        '''
+        cursor = Transaction().cursor
+        tables = {}
+        for _, Model in POOL.iterobject():
+            if issubclass(Model, ModelSQL) and not Model.table_query():
+                table = Model.__table__()
+                cursor.execute(*table.select(Max(table.id)))
+                tables[Model._table] = (table, cursor.fetchone()[0] or 0)
+        try:
+            yield
+        finally:
+            cursor = Transaction().cursor
+            cursor.rollback()
+            for table, last_id in tables.itervalues():
+                cursor.execute(*table.delete(where=table.id > last_id))
+            cursor.commit()
+
     def test_0010_get_or_create_room(self):
         """
         Create a room for a 1:1 chat and check if it works
@@ -241,7 +292,27 @@ class TestChat(NereidTestCase):
                 r_13, self.Chat.get_or_create_room(user_1_1, user_1_3)
             )
             self.assertEqual(
-                r_23, self.Chat.get_or_create_room(user_1_1, user_1_2)
+                r_23, self.Chat.get_or_create_room(user_1_2, user_1_3)
+            )
+
+            # Rooms with more members are not rooms of fewer members
+            self.assertEqual(len(set([r_123, r_12, r_13, r_23])), 4)
+
+            # The key follows the changes of members, but the room of the
+            # remaining members stays the one it was
+            self.ChatMember.delete([
+                m for m in r_123.members if m.user == user_1_3
+            ])
+            self.assertEqual(self.Chat(r_123.id).member_key, None)
+            self.assertEqual(
+                r_12, self.Chat.get_or_create_room(user_1_1, user_1_2)
+            )
+            self.ChatMember.delete([
+                m for m in r_12.members if m.user == user_1_2
+            ])
+            self.assertEqual(
+                self.Chat(r_12.id).member_key,
+                self.Chat.get_member_key([user_1_1])
             )
 
     def test_0040_post_message(self):
@@ -316,6 +387,34 @@ class TestChat(NereidTestCase):
                 )
                 self.assertEqual(rv.status_code, 200)
 
+                # The message is in the history of the thread
+                rv = c.get(
+                    '/nereid-chat/history/%s' % response_json['thread_id']
+                )
+                self.assertEqual(rv.status_code, 200)
+                history = json.loads(rv.data)
+                self.assertEqual(len(history['messages']), 1)
+                self.assertEqual(
+                    history['messages'][0]['message']['text'], 'Send Message'
+                )
+                self.assertEqual(history['next'], None)
+
+                # The limit is clamped and a malformed cursor is refused
+                for limit in (0, -5):
+                    rv = c.get('/nereid-chat/history/%s?limit=%d' % (
+                        response_json['thread_id'], limit
+                    ))
+                    self.assertEqual(rv.status_code, 200)
+                    history = json.loads(rv.data)
+                    self.assertEqual(len(history['messages']), 1)
+                rv = c.get('/nereid-chat/history/%s?before=abc' % (
+                    response_json['thread_id']
+                ))
+                self.assertEqual(rv.status_code, 400)
+
+                rv = c.get('/nereid-chat/history/wrong-thread')
+                self.assertEqual(rv.status_code, 404)
+
     def test_0050_token_creation(self):
         """
         Test creation of token
@@ -347,7 +446,12 @@ class TestChat(NereidTestCase):
                 rv = c.post('/nereid-chat/token')
                 self.assertEqual(rv.status_code, 200)
 
-                self.assertTrue('token' in json.loads(rv.data))
+                token = json.loads(rv.data)['token']
+                ttl = app.redis_client.ttl('chat:token:%s' % token)
+                self.assertTrue(0 < ttl <= 3600)
+
+        # Outside of the application the client of the process is shared
+        self.assertTrue(get_redis_client() is get_redis_client())
 
     def test_0060_token_event_stream(self):
         """
@@ -375,6 +479,1069 @@ class TestChat(NereidTestCase):
                 rv = c.get('/nereid-chat/stream/%s' % token)
                 self.assertEqual(rv.status_code, 200)
 
+                # The token is validated once for a while
+                app.redis_client.delete('chat:token:%s' % token)
+                rv = c.get('/nereid-chat/stream/%s' % token)
+                self.assertEqual(rv.status_code, 200)
+
+    def test_0070_redis_hub_dispatch(self):
+        """
+        Check that the redis hub delivers the messages received by the
+        subscriber only to the users listening in this worker
+        """
+        hub = RedisMessageQueue()
+        # A user listening in this worker has a subscription. It is made
+        # without starting the subscriber which would block the tests.
+        subscription = MessageQueue.subscribe(hub, 1, 'nereid_chat:db')
+
+        hub.dispatch({
+            'type': 'message',
+            'channel': hub.get_channel('nereid_chat:db', 1),
+            'data': 'message - %s' % json.dumps({'type': 'message'}),
+        })
+        hub.dispatch({
+            'type': 'message',
+            'channel': hub.get_channel('nereid_chat:db', 2),
+            'data': 'message - %s' % json.dumps({'type': 'message'}),
+        })
+        self.assertEqual(subscription.get(0), Stanza({'type': 'message'}))
+        self.assertFalse(hub.store)
+
+        # The subscriber skips the messages it cannot dispatch
+        hub = RedisMessageQueue()
+        hub._redis = FakeRedis()
+        subscription = hub.subscribe(1, 'nereid_chat:db')
+        try:
+            gevent.sleep(0)
+            channel = hub.get_channel('nereid_chat:db', 1)
+            hub.redis.publish(channel, 'garbage')
+            hub.redis.publish(
+                channel, 'message - %s' % json.dumps({'type': 'message'}),
+            )
+            self.assertEqual(
+                subscription.get(timeout=1), Stanza({'type': 'message'})
+            )
+            self.assertFalse(hub._subscriber.dead)
+
+            # Only the channels of the users and rooms with a stream in
+            # this worker are subscribed
+            self.assertEqual(
+                hub.redis.publish(hub.get_channel('nereid_chat:db', 2), '-'),
+                0
+            )
+            hub.join(subscription, {'thread-1': None})
+            stream = hub.subscribe(2, 'nereid_chat:db', {'thread-1': None})
+            gevent.sleep(0)
+            room = hub.get_room_channel('nereid_chat:db', 'thread-1')
+            self.assertEqual(sorted(hub._pubsub.channels), sorted([
+                channel, room, hub.get_channel('nereid_chat:db', 2)
+            ]))
+            hub.unsubscribe(subscription)
+            self.assertEqual(sorted(hub._pubsub.channels), sorted([
+                room, hub.get_channel('nereid_chat:db', 2)
+            ]))
+            hub.unsubscribe(stream)
+            self.assertFalse(hub.channels)
+
+            # The subscriber stops with the last stream and starts again
+            # with the next one
+            gevent.sleep(0)
+            self.assertTrue(hub._subscriber.dead)
+            subscription = hub.subscribe(1, 'nereid_chat:db')
+            gevent.sleep(0)
+            self.assertEqual(hub._pubsub.channels.keys(), [channel])
+        finally:
+            gevent.killall([hub._subscriber, hub._heartbeat])
+
+    def test_0080_fan_out_to_all_streams(self):
+        """
+        Check that every stream of a user gets every message and that the
+        messages wait for users without a stream
+        """
+        hub = MessageQueue()
+        tab_1 = hub.subscribe(1, 'nereid_chat')
+        tab_2 = hub.subscribe(1, 'nereid_chat')
+
+        # The stanza encoded once is shared by the streams
+        stanza = Stanza({'type': 'message'})
+        hub.deliver('nereid_chat', 1, stanza)
+        self.assertTrue(tab_1.get(0) is stanza)
+        self.assertTrue(tab_2.get(0) is stanza)
+        self.assertEqual(stanza.frame, 'data: {"type": "message"}\n\n')
+
+        hub.unsubscribe(tab_1)
+        hub.unsubscribe(tab_2)
+        self.assertFalse(hub.subscriptions['nereid_chat'])
+
+        hub.deliver('nereid_chat', 1, Stanza({'type': 'presence'}))
+        tab_3 = hub.subscribe(1, 'nereid_chat')
+        self.assertEqual(tab_3.get(0), Stanza({'type': 'presence'}))
+
+    def test_0090_bounded_queues(self):
+        """
+        Check the overflow policy, eviction and accounting of the queues
+        """
+        hub = MessageQueue(
+            backlog_size=2, overflow='drop_presence', backlog_ttl=60
+        )
+        hub.deliver('nereid_chat', 1, Stanza({'type': 'message', 'id': 1}))
+        hub.deliver('nereid_chat', 1, Stanza({'type': 'presence'}))
+        hub.deliver('nereid_chat', 1, Stanza({'type': 'message', 'id': 2}))
+
+        usage = hub.get_usage('nereid_chat')
+        self.assertEqual(usage['buffers'], 1)
+        self.assertEqual(usage['messages'], 2)
+        self.assertEqual(usage['dropped'], 1)
+        self.assertEqual(
+            list(hub.get_queue(1, 'nereid_chat').items), [
+                Stanza({'type': 'message', 'id': 1}),
+                Stanza({'type': 'message', 'id': 2}),
+            ]
+        )
+
+        hub.evict_idle(time.time() + 61)
+        self.assertFalse(hub.store['nereid_chat'])
+        self.assertEqual(usage['buffers'], 0)
+        self.assertEqual(usage['messages'], 0)
+        self.assertEqual(usage['evicted'], 1)
+
+    def test_0100_presence_debounce(self):
+        """
+        Check that only the changes of presence are broadcast within the
+        debounce window
+        """
+        hub = MessageQueue(presence_debounce=60)
+        presence = {'entity': {'id': 1}, 'available': True}
+
+        self.assertTrue(hub.presence_changed(1, presence, 'nereid_chat'))
+        self.assertFalse(hub.presence_changed(1, presence, 'nereid_chat'))
+        self.assertTrue(hub.presence_changed(
+            1, {'entity': {'id': 1}, 'available': False}, 'nereid_chat'
+        ))
+
+        # Once the window has passed the presence is broadcast again
+        hub.last_presence[('nereid_chat', 1)] = (presence, time.time() - 61)
+        self.assertTrue(hub.presence_changed(1, presence, 'nereid_chat'))
+
+    def test_0110_presence_to_online_friends(self):
+        """
+        Check that the presence is published only to the friends who have
+        a stream connected
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+
+            user_1, user_2, user_3 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'nome',
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2, 3)])
+
+            subscription = MQ.subscribe(user_2.id)
+            try:
+                self.assertEqual(MQ.get_online_users(), set([user_2.id]))
+                user_1.broadcast_presence(force=True)
+
+                presence = json.loads(subscription.get(0).payload)
+                self.assertEqual(presence['type'], 'presence')
+                self.assertEqual(
+                    presence['presence']['entity']['id'], user_1.id
+                )
+                self.assertEqual(MQ.user_backlog(user_3.id), 0)
+            finally:
+                MQ.unsubscribe(subscription)
+
+            # The user stays online for the grace period after the stream
+            # is closed
+            self.assertTrue(MQ.is_user_online(user_2.id))
+            self.assertTrue(user_2.chat_available)
+            MQ.last_seen[DB_NAME][user_2.id] -= MQ.presence_grace + 1
+            self.assertEqual(MQ.get_online_users(), set())
+            self.assertEqual(
+                self.NereidUser.get_available([user_1, user_2], None),
+                {user_1.id: False, user_2.id: False}
+            )
+
+            # The stream of a user is connected before its presence is
+            # broadcast, so the friends see the user available
+            app = self.get_app()
+            subscription = MQ.subscribe(user_2.id)
+            try:
+                with app.test_client() as c:
+                    rv = c.post('/login', data={
+                        'email': 'user1@openlabs.co.in',
+                        'password': 'password',
+                    })
+                    self.assertEqual(rv.status_code, 302)
+                    rv = c.get('/nereid-chat/stream', buffered=False)
+                    self.assertEqual(rv.status_code, 200)
+
+                    presence = json.loads(subscription.get(0).payload)
+                    self.assertEqual(
+                        presence['presence']['entity']['id'], user_1.id
+                    )
+                    self.assertTrue(presence['presence']['available'])
+                    rv.close()
+                # The stream closed before it started releases its
+                # subscription all the same
+                self.assertFalse(MQ.get_subscriptions(user_1.id, DB_NAME))
+            finally:
+                MQ.unsubscribe(subscription)
+
+    def test_0120_get_friends(self):
+        """
+        Check the presence of the friends, with and without pagination
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+            app = self.get_app()
+
+            user_1, user_2, _ = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'nome',
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2, 3)])
+            login_data = {
+                'email': 'user1@openlabs.co.in',
+                'password': 'password',
+            }
+            with app.test_client() as c:
+                rv = c.post('/login', data=login_data)
+                self.assertEqual(rv.status_code, 302)
+
+                # The guest user and the other two users
+                rv = c.get('/nereid-chat/get-friends')
+                self.assertEqual(rv.status_code, 200)
+                response_json = json.loads(rv.data)
+                self.assertEqual(len(response_json['friends']), 3)
+                self.assertEqual(response_json['total'], 3)
+
+                rv = c.get('/nereid-chat/get-friends?offset=1&limit=1')
+                self.assertEqual(rv.status_code, 200)
+                response_json = json.loads(rv.data)
+                self.assertEqual(len(response_json['friends']), 1)
+                self.assertEqual(
+                    response_json['friends'][0]['available'], False
+                )
+                self.assertEqual(response_json['total'], 3)
+                # The page is the second friend of the whole list
+                rv = c.get('/nereid-chat/get-friends')
+                self.assertEqual(
+                    json.loads(rv.data)['friends'][1],
+                    response_json['friends'][0]
+                )
+
+                rv = c.get('/nereid-chat/get-friends?offset=2&limit=5')
+                self.assertEqual(len(json.loads(rv.data)['friends']), 1)
+
+                # The friends of a page are read from the cache at once
+                calls = []
+                get_many = USER_CACHE.get_many
+                USER_CACHE.get_many = lambda keys: calls.append(keys) or \
+                    get_many(keys)
+                try:
+                    rv = c.get('/nereid-chat/get-friends')
+                finally:
+                    del USER_CACHE.get_many
+                self.assertEqual(len(json.loads(rv.data)['friends']), 3)
+                self.assertEqual(len(calls), 1)
+
+                # The friends of a module overriding get_chat_friends are
+                # listed
+                self.assertFalse(user_1.chat_friends_overridden())
+                self.NereidUser.get_chat_friends = lambda self: \
+                    self.search([('email', '=', 'user2@openlabs.co.in')])
+                try:
+                    self.assertTrue(user_1.chat_friends_overridden())
+                    rv = c.get('/nereid-chat/get-friends?limit=5')
+                finally:
+                    del self.NereidUser.get_chat_friends
+                response_json = json.loads(rv.data)
+                self.assertEqual(response_json['total'], 1)
+                self.assertEqual(
+                    response_json['friends'][0]['entity']['id'], user_2.id
+                )
+
+    def test_0130_stanza_batches(self):
+        """
+        Check that the stanzas which are ready are sent in batches
+        """
+        hub = MessageQueue(batch_size=2)
+        stanzas = [
+            Stanza({'type': 'message', 'id': index}) for index in range(3)
+        ]
+        for stanza in stanzas:
+            hub.deliver('nereid_chat', 1, stanza)
+
+        batches = hub.listen_batches(1, 'nereid_chat')
+        self.assertEqual(batches.next(), stanzas[:2])
+        self.assertEqual(batches.next(), stanzas[2:])
+        batches.close()
+        self.assertFalse(hub.subscriptions['nereid_chat'])
+
+        frame = batch_frame(stanzas[:2])
+        self.assertTrue(frame.startswith('data: ') and frame.endswith('\n\n'))
+        self.assertEqual(
+            json.loads(frame[6:])['stanzas'],
+            [{'type': 'message', 'id': 0}, {'type': 'message', 'id': 1}]
+        )
+
+    def test_0140_write_behind(self):
+        """
+        Check that the write behind buffer hands the messages over in
+        batches, pushes back when full and retries the batches which fail
+        """
+        batches = []
+
+        class TestWriteBehind(WriteBehind):
+            def write(self, items):
+                batches.append(items)
+
+        write_behind = TestWriteBehind(
+            maxsize=3, batch_size=2, flush_interval=0
+        )
+        # Do not let the writer run
+        write_behind._writer = gevent.spawn(lambda: None)
+        for index in range(3):
+            self.assertTrue(
+                write_behind.put('nereid_chat', {'message': index})
+            )
+        self.assertFalse(
+            write_behind.put('nereid_chat', {'message': 3}, timeout=0)
+        )
+
+        self.assertEqual(len(write_behind.take()), 2)
+        # Taken by hand, so not waiting for a write
+        write_behind._pending = []
+        write_behind.flush()
+        self.assertEqual(batches, [[('nereid_chat', {'message': 2})]])
+
+        # The messages the writer took are written by the flush too
+        del batches[:]
+        write_behind = TestWriteBehind(batch_size=10, flush_interval=10)
+        for index in range(2):
+            write_behind.put('nereid_chat', {'message': index})
+        gevent.sleep(0)
+        self.assertTrue(write_behind.queue.empty())
+        write_behind.flush()
+        self.assertTrue(write_behind._writer.dead)
+        self.assertEqual(batches, [[
+            ('nereid_chat', {'message': 0}), ('nereid_chat', {'message': 1}),
+        ]])
+
+        # A batch which fails is tried again, and then message by message
+        # so that only the message which cannot be saved is lost
+        failures = []
+
+        class FailingWriteBehind(WriteBehind):
+            def create(self, dbname, vlist):
+                if not failures:
+                    failures.append(vlist)
+                    raise Exception('The database is gone')
+                return super(FailingWriteBehind, self).create(dbname, vlist)
+
+        write_behind = FailingWriteBehind(retries=1, retry_delay=0)
+        write_behind.write([
+            (DB_NAME, {'chat': 1, 'user': 1, 'message': 'first'}),
+            (DB_NAME, {'user': 1, 'message': 'no chat'}),
+        ])
+        write_behind.write([
+            (DB_NAME, {'chat': 1, 'user': 1, 'message': 'second'}),
+        ])
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            Message = POOL.get('nereid.chat.message')
+            messages = Message.search([], order=[('id', 'ASC')])
+            self.assertEqual(
+                [message.message for message in messages],
+                ['first', 'second']
+            )
+            Message.delete(messages)
+            Transaction().cursor.commit()
+
+    def test_0150_message_stores(self):
+        """
+        Check that the message stores return the history of a thread by
+        pages
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+
+            user_1, user_2 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'nome',
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2)])
+            chat = self.Chat.get_or_create_room(user_1.id, user_2.id)
+
+            for store in (SQLMessageStore(), RedisMessageStore()):
+                for index in range(3):
+                    store.append(chat, user_1, json.dumps({'id': index}))
+
+                page = store.range(chat, limit=2)
+                self.assertEqual(
+                    [json.loads(message) for _, message in page],
+                    [{'id': 2}, {'id': 1}]
+                )
+                page = store.range(chat, before=page[-1][0], limit=2)
+                self.assertEqual(
+                    [json.loads(message) for _, message in page],
+                    [{'id': 0}]
+                )
+                self.assertRaises(ValueError, store.range, chat, 'abc')
+
+    def test_0160_caches(self):
+        """
+        Check the expiry and the eviction of the caches
+        """
+        cache = LRUCache(size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+
+        cache = RedisCache('test', ttl=60)
+        cache.set('a', {'members': [1, 2]})
+        self.assertEqual(cache.get('a'), {'members': [1, 2]})
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+
+        # With the redis hub the caches are shared by the processes
+        self.assertTrue(isinstance(get_thread_cache(), LRUCache))
+        hub = CONFIG.get('chat_hub')
+        CONFIG['chat_hub'] = 'redis'
+        try:
+            self.assertTrue(isinstance(get_thread_cache(), RedisCache))
+        finally:
+            CONFIG['chat_hub'] = hub
+
+    def test_0170_thread_cache(self):
+        """
+        Check that the members of a thread are cached until they change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+            app = self.get_app()
+
+            user_1, user_2, user_3 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'user%d' % index,
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2, 3)])
+            chat = self.Chat.get_or_create_room(user_1.id, user_2.id)
+
+            thread = self.Chat.get_thread(chat.thread)
+            self.assertEqual(thread['id'], chat.id)
+            self.assertEqual(
+                set(thread['members']), set([user_1.id, user_2.id])
+            )
+            self.assertTrue(self.Chat.get_thread(chat.thread) is thread)
+            self.assertEqual(self.Chat.get_thread('wrong-thread'), None)
+
+            self.ChatMember.create([{'chat': chat.id, 'user': user_3.id}])
+            thread = self.Chat.get_thread(chat.thread)
+            self.assertEqual(len(thread['members']), 3)
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'user1@openlabs.co.in',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                # The thread is now a room, whose roster the user got
+                backlog = MQ.store[DB_NAME][user_3.id]
+                roster = json.loads(backlog.items[-1].payload)
+                self.assertEqual(roster['type'], 'join')
+                self.assertEqual(len(roster['members']), 3)
+
+                subscription = MQ.subscribe(
+                    user_3.id, DB_NAME, self.Chat.get_rooms(user_3.id)
+                )
+                rv = c.post('/nereid-chat/send-message', data={
+                    'message': 'Hello',
+                    'thread_id': chat.thread,
+                })
+                self.assertEqual(rv.status_code, 200)
+                message = json.loads(subscription.items[-1].payload)
+                self.assertEqual(
+                    message['message']['sender']['displayName'], 'user1'
+                )
+                self.assertFalse('members' in message['message'])
+
+                # Once removed from the thread, the user cannot send to it
+                self.ChatMember.delete([
+                    m for m in chat.members if m.user == user_1
+                ])
+                rv = c.post('/nereid-chat/send-message', data={
+                    'message': 'Hello',
+                    'thread_id': chat.thread,
+                })
+                self.assertEqual(rv.status_code, 404)
+
+    def test_0180_user_cache(self):
+        """
+        Check that the users are serialized once until they are written
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+
+            user_1, user_2 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'user%d' % index,
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2)])
+
+            serialized = self.NereidUser.get_serialized(
+                [user_2.id, user_1, user_2]
+            )
+            self.assertEqual(
+                [entity['displayName'] for entity in serialized],
+                ['user2', 'user1', 'user2']
+            )
+            self.assertEqual(
+                USER_CACHE.get(self.NereidUser.get_user_key(user_1.id)),
+                user_1.serialize()
+            )
+            self.assertEqual(
+                user_1.get_presence(available=False)['entity'],
+                serialized[1]
+            )
+
+            self.NereidUser.write([user_1], {'display_name': 'renamed'})
+            self.assertEqual(
+                USER_CACHE.get(self.NereidUser.get_user_key(user_1.id)), None
+            )
+            entity, = self.NereidUser.get_serialized([user_1.id])
+            self.assertEqual(entity['displayName'], 'renamed')
+
+    def test_0190_stream_resumption(self):
+        """
+        Check that a reconnecting stream gets the events it missed
+        """
+        hub = MessageQueue(replay_size=3)
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            for index in range(4):
+                hub.publish(1, {'type': 'message', 'id': index})
+        deliveries = list(hub.remove_queue(1, DB_NAME).items)
+        ids = [delivery.id for delivery in deliveries]
+        self.assertEqual(
+            deliveries[0].frame,
+            'id: %s\ndata: {"type": "message", "id": 0}\n\n' % ids[0]
+        )
+
+        # The stream received the first two events before reconnecting
+        stream = hub.listen(1, DB_NAME, str(ids[1]))
+        self.assertEqual(
+            [stream.next().id, stream.next().id], [ids[2], ids[3]]
+        )
+        # The events the stream got while resuming are not sent twice
+        hub.deliver(DB_NAME, 1, deliveries[3])
+        hub.deliver(DB_NAME, 1, Stanza({'type': 'presence'}))
+        self.assertEqual(stream.next().type, 'presence')
+        stream.close()
+
+        # The first event is not kept anymore
+        stream = hub.listen(1, DB_NAME, str(ids[0]))
+        self.assertEqual(stream.next().type, 'resync')
+        stream.close()
+
+        self.assertEqual(
+            batch_frame(deliveries[2:]).split('\n', 1)[0], 'id: %s' % ids[3]
+        )
+        # A batch ending with a stanza without id has the last event id
+        frame = batch_frame(deliveries[2:] + [Stanza({'type': 'presence'})])
+        self.assertEqual(frame.split('\n', 1)[0], 'id: %s' % ids[3])
+
+        hub = RedisMessageQueue(replay_size=3)
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            ids = [
+                hub.publish(1, {'type': 'message', 'id': index})
+                for index in range(4)
+            ]
+        self.assertEqual(
+            [
+                (delivery.id, delivery.payload)
+                for delivery in hub.replay(1, DB_NAME, ids[1])
+            ],
+            [
+                (ids[2], '{"type": "message", "id": 2}'),
+                (ids[3], '{"type": "message", "id": 3}'),
+            ]
+        )
+        self.assertEqual(hub.replay(1, DB_NAME, 'wrong-id'), None)
+        # More events than the window holds came after the first one
+        self.assertEqual(hub.replay(1, DB_NAME, ids[0]), None)
+
+    def test_0200_keepalive_wheel(self):
+        """
+        Check that only the streams idle for the interval are woken up
+        """
+        hub = MessageQueue(keepalive_interval=3)
+        idle = hub.subscribe(1, 'nereid_chat')
+        busy = hub.subscribe(2, 'nereid_chat')
+        wheel = hub.keepalive
+        self.assertEqual(len(wheel), 2)
+
+        now = time.time()
+        idle.last_activity = busy.last_activity = now
+        wheel.tick(now + 1)
+        wheel.tick(now + 2)
+        busy.last_activity = now + 2
+        wheel.tick(now + 3)
+        self.assertRaises(queue.Empty, idle.get)
+        # The busy stream is checked again when it will have been idle
+        self.assertEqual(busy.slot, (wheel.position + 2) % len(wheel.slots))
+        self.assertEqual(idle.slot, (wheel.position + 3) % len(wheel.slots))
+        hub.unsubscribe(idle)
+        hub.unsubscribe(busy)
+
+        # A stream woken up sends a keepalive comment
+        stream = hub.listen(1, 'nereid_chat')
+        frames = gevent.spawn(lambda: stream.next().frame)
+        gevent.sleep(0)
+        subscription, = hub.get_subscriptions(1, 'nereid_chat')
+        subscription.wake()
+        self.assertEqual(frames.get(timeout=1), ':\n\n')
+        stream.close()
+        self.assertEqual(len(wheel), 0)
+
+        # The streams forgotten by the hub are not checked anymore
+        idle = hub.subscribe(1, 'nereid_chat')
+        hub.clear()
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(idle.slot, None)
+
+    def test_0210_websocket(self):
+        """
+        Check that the stanzas go both ways on the websocket
+        """
+        class WebSocket(object):
+            def __init__(self, received):
+                self.received = list(received)
+                self.sent = []
+
+            def receive(self):
+                # Let the stanzas for the user be sent
+                gevent.sleep(0)
+                if self.received:
+                    return self.received.pop(0)
+                return None
+
+            def send(self, data):
+                self.sent.append(json.loads(data))
+
+        # The socket commits each stanza
+        with Transaction().start(DB_NAME, USER, CONTEXT), self.committed():
+            data = self.setup_defaults()
+            app = self.get_app()
+            Message = POOL.get('nereid.chat.message')
+
+            user_1, user_2 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'user%d' % index,
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2)])
+            chat = self.Chat.get_or_create_room(user_1.id, user_2.id)
+            # The records are bound to the cursor a detached stream closes
+            thread = chat.thread
+
+            with app.test_client() as c:
+                rv = c.get('/nereid-chat/socket')
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.post('/login', data={
+                    'email': 'user1@openlabs.co.in',
+                    'password': 'password',
+                })
+                self.assertEqual(rv.status_code, 302)
+
+                rv = c.get('/nereid-chat/socket')
+                self.assertEqual(rv.status_code, 400)
+
+                # With the streams detached, the default, and attached
+                for detach in (True, False):
+                    websocket = WebSocket([
+                        json.dumps({
+                            'type': 'message',
+                            'ref': 1,
+                            'message': {
+                                'thread': thread, 'text': 'Hello',
+                            },
+                        }),
+                        json.dumps({
+                            'type': 'message',
+                            'ref': 2,
+                            'message': {
+                                'thread': 'wrong-thread', 'text': 'Hello',
+                            },
+                        }),
+                        'not a stanza',
+                    ])
+                    chat_module.DETACH_STREAMS = detach
+                    try:
+                        rv = c.get(
+                            '/nereid-chat/socket',
+                            environ_overrides={'wsgi.websocket': websocket}
+                        )
+                    finally:
+                        chat_module.DETACH_STREAMS = True
+                    self.assertEqual(rv.status_code, 200)
+
+                    ack, message, error, invalid = websocket.sent
+                    self.assertEqual(ack['type'], 'ack')
+                    self.assertEqual(ack['ref'], 1)
+                    self.assertEqual(message['type'], 'message')
+                    self.assertEqual(message['message']['id'], ack['UUID'])
+                    self.assertEqual(message['message']['text'], 'Hello')
+                    self.assertEqual(
+                        (error['type'], error['ref']), ('error', 2)
+                    )
+                    self.assertEqual(invalid['type'], 'error')
+
+                    # The other member gets the message too, and the stream
+                    # of the socket is gone
+                    backlog = MQ.store[DB_NAME][user_2.id]
+                    self.assertEqual(
+                        json.loads(
+                            backlog.items[-1].payload
+                        )['message']['id'],
+                        ack['UUID']
+                    )
+                    self.assertFalse(
+                        MQ.get_subscriptions(user_1.id, DB_NAME)
+                    )
+                    self.assertEqual(MQ.get_usage(DB_NAME)['cursors'], 0)
+
+            # The malformed stanzas are answered with an error
+            for frame in [
+                    '[]', '"message"', '{"type": 1}',
+                    '{"type": "message", "message": "hi"}',
+                    '{"type": "message", "message": {"thread": ["a"], '
+                    '"text": "hi"}}',
+                    '{"type": "message", "message": {"thread": "a", '
+                    '"text": {}}}']:
+                self.assertEqual(
+                    self.Chat.receive_from_socket(user_1, frame)['type'],
+                    'error'
+                )
+
+            # The messages were committed
+            Transaction().cursor.rollback()
+            self.assertEqual(
+                Message.search_count([('chat', '=', chat.id)]), 2
+            )
+
+    def test_0220_detached_streams(self):
+        """
+        Check that a detached stream does not hold a cursor, but for the
+        stanzas it receives
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT), self.committed():
+            data = self.setup_defaults()
+            usage = MQ.get_usage(DB_NAME)
+            with stream_cursor(DB_NAME):
+                self.assertEqual(Transaction().cursor, None)
+                with stanza_cursor(DB_NAME):
+                    self.assertTrue(Transaction().cursor is not None)
+                    self.assertEqual(usage['cursors'], 1)
+                    self.NereidUser.create([{
+                        'party': data['test_party'].id,
+                        'display_name': 'user',
+                        'email': 'user@openlabs.co.in',
+                        'company': data['company'].id,
+                    }])
+                self.assertEqual(Transaction().cursor, None)
+            self.assertEqual(usage['cursors'], 0)
+
+            # The work of the request was committed before the stream, and
+            # the one of the stanza at its end
+            Transaction().cursor.rollback()
+            self.assertEqual(
+                self.Currency.search_count([('code', '=', 'USD')]), 1
+            )
+            self.assertEqual(
+                self.NereidUser.search_count([
+                    ('email', '=', 'user@openlabs.co.in'),
+                ]), 1
+            )
+
+    def test_0230_metrics(self):
+        """
+        Check that the metrics of the chat are exposed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+            app = self.get_app()
+
+            user_1, user_2 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'user%d' % index,
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2)])
+            chat = self.Chat.get_or_create_room(user_1.id, user_2.id)
+            MQ.subscribe(user_2.id)
+
+            with app.test_client() as c:
+                rv = c.post('/login', data={
+                    'email': 'user1@openlabs.co.in',
+                    'password': 'password',
+                })
+                rv = c.post('/nereid-chat/send-message', data={
+                    'message': 'Hello',
+                    'thread_id': chat.thread,
+                })
+                self.assertEqual(rv.status_code, 200)
+
+                rv = c.get('/nereid-chat/metrics')
+                self.assertEqual(rv.status_code, 200)
+                lines = rv.data.splitlines()
+                for line in [
+                        'chat_published_total{dbname="%s",type="message"} 2',
+                        'chat_published_total{dbname="%s",type="presence"} 1',
+                        'chat_presence_fanout_count{dbname="%s"} 1',
+                        'chat_send_message_seconds_count{dbname="%s"} 1',
+                        'chat_save_message_seconds_count{dbname="%s"} 1',
+                        'chat_streams{dbname="%s"} 1',
+                        'chat_queue_depth_max{dbname="%s"} 2',
+                        ]:
+                    self.assertTrue(line % DB_NAME in lines, line)
+                self.assertTrue('# TYPE chat_published_total counter' in lines)
+
+                CONFIG['chat_metrics_token'] = 'secret'
+                try:
+                    rv = c.get('/nereid-chat/metrics')
+                    self.assertEqual(rv.status_code, 403)
+                    rv = c.get(
+                        '/nereid-chat/metrics',
+                        headers={'Authorization': 'Bearer secret'}
+                    )
+                    self.assertEqual(rv.status_code, 200)
+                finally:
+                    CONFIG['chat_metrics_token'] = None
+
+    def test_0240_trace(self):
+        """
+        Check that the stages of the delivery of a traced message are
+        observed, and that the trace goes along the message over redis
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+            user_1, user_2 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'user%d' % index,
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2)])
+            chat = self.Chat.get_or_create_room(user_1.id, user_2.id)
+
+            MQ.trace = True
+            chat_module.DETACH_STREAMS = False
+            try:
+                self.Chat.post_message(user_1, chat.thread, 'Hello')
+                stream = self.Chat.generate_event_stream(user_2.id, DB_NAME)
+                self.assertTrue('"Hello"' in next(stream))
+                # The message is flushed when the next frame is asked for
+                MQ.publish(user_2.id, {'type': 'presence'})
+                self.assertTrue('"presence"' in next(stream))
+                stream.close()
+            finally:
+                MQ.trace = False
+                chat_module.DETACH_STREAMS = True
+
+            for stage in ('persist', 'presence', 'publish', 'dequeue',
+                          'flush'):
+                counts = STAGE_SECONDS.values[(DB_NAME, stage)]
+                self.assertEqual(sum(counts[:-1]), 1, stage)
+            counts = DELIVERY_SECONDS.values[(DB_NAME, 'sse')]
+            self.assertEqual(sum(counts[:-1]), 1)
+
+            # Untraced messages are not observed
+            self.Chat.post_message(user_1, chat.thread, 'Hello')
+            counts = STAGE_SECONDS.values[(DB_NAME, 'persist')]
+            self.assertEqual(sum(counts[:-1]), 1)
+
+        trace = Trace(accept=1.5, publish=2.25)
+        self.assertEqual(Trace.decode(trace.encode()), trace)
+
+        hub = RedisMessageQueue(trace=True)
+        subscription = MessageQueue.subscribe(hub, 1, 'nereid_chat')
+        for trace in [trace.encode(), '-']:
+            hub.dispatch({
+                'type': 'message',
+                'channel': 'chat:nereid_chat:1',
+                'data': 'message 1-0 %s {"type": "message"}' % trace,
+            })
+        stanza = subscription.get()
+        self.assertEqual(stanza.id, '1-0')
+        self.assertEqual(stanza.payload, '{"type": "message"}')
+        self.assertEqual(stanza.trace, {'accept': 1.5, 'publish': 2.25})
+        self.assertEqual(subscription.get().trace, None)
+
+    def test_0250_rooms(self):
+        """
+        Check that the messages of a room are published once to the streams
+        joined to the room, which get the roster when they join
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            data = self.setup_defaults()
+            user_1, user_2, user_3, user_4 = self.NereidUser.create([{
+                'party': data['test_party'],
+                'display_name': 'user%d' % index,
+                'email': 'user%d@openlabs.co.in' % index,
+                'password': 'password',
+                'company': data['company'],
+            } for index in (1, 2, 3, 4)])
+            chat = self.Chat.get_or_create_room(
+                user_1.id, user_2.id, user_3.id
+            )
+            rooms = self.Chat.get_rooms(user_1.id)
+            self.assertEqual(rooms.keys(), [chat.thread])
+            self.assertEqual(self.Chat.get_rooms(user_4.id), {})
+
+            stream_1 = MQ.subscribe(user_1.id, DB_NAME, rooms)
+            stream_2 = MQ.subscribe(
+                user_2.id, DB_NAME, self.Chat.get_rooms(user_2.id)
+            )
+            stream_4 = MQ.subscribe(user_4.id, DB_NAME)
+            roster = json.loads(stream_1.items[0].payload)
+            self.assertEqual(roster['type'], 'join')
+            self.assertEqual(roster['thread'], chat.thread)
+            self.assertEqual(len(roster['members']), 3)
+
+            REGISTRY.clear()
+            self.Chat.post_message(user_1, chat.thread, 'Hello')
+            self.assertEqual(
+                PUBLISHED.values[(DB_NAME, 'message')], 1
+            )
+            first = stream_1.items[-1]
+            self.assertEqual(stream_2.items[-1], first)
+            message = json.loads(first.payload)['message']
+            self.assertEqual(message['text'], 'Hello')
+            self.assertFalse('members' in message)
+            # The members without a stream do not get it
+            self.assertEqual(
+                [item.type for item in MQ.store[DB_NAME][user_3.id].items],
+                ['join']
+            )
+
+            # The rooms of the users are cached
+            self.assertEqual(
+                ROOM_CACHE.get(self.Chat.get_rooms_key(user_4.id)), []
+            )
+
+            # A member added joins the room right away, and the roster is
+            # published once to the room and to the member added
+            REGISTRY.clear()
+            self.ChatMember.create([{'chat': chat.id, 'user': user_4.id}])
+            self.assertEqual(PUBLISHED.values[(DB_NAME, 'join')], 2)
+            self.assertEqual(stream_4.items[-1].type, 'join')
+            self.assertEqual(stream_4.rooms, set([chat.thread]))
+            self.assertEqual(
+                len(json.loads(stream_1.items[-1].payload)['members']), 4
+            )
+            self.assertEqual(stream_2.items[-1], stream_1.items[-1])
+            self.assertEqual(
+                self.Chat.get_rooms(user_4.id).keys(), [chat.thread]
+            )
+
+            # A member removed leaves it
+            self.ChatMember.delete([
+                m for m in chat.members if m.user == user_2
+            ])
+            self.assertEqual(stream_2.items[-1].type, 'leave')
+            self.assertEqual(stream_2.rooms, set())
+            self.assertEqual(self.Chat.get_rooms(user_2.id), {})
+
+            self.Chat.post_message(user_1, chat.thread, 'Bye')
+            self.assertEqual(stream_4.items[-1].type, 'message')
+            self.assertEqual(stream_2.items[-1].type, 'leave')
+
+            # A stream resuming gets the events of the rooms since
+            stream = MQ.listen(
+                user_1.id, DB_NAME, str(first.id),
+                self.Chat.get_rooms(user_1.id),
+            )
+            # The rosters as user_4 was added and user_2 removed, the
+            # message, then the roster of the room as the stream joins it
+            self.assertEqual(stream.next().type, 'join')
+            self.assertEqual(stream.next().type, 'join')
+            self.assertEqual(
+                json.loads(stream.next().payload)['message']['text'], 'Bye'
+            )
+            self.assertEqual(stream.next().type, 'join')
+            stream.close()
+
+            MQ.unsubscribe(stream_1)
+            self.assertEqual(MQ.rooms[DB_NAME][chat.thread], set([stream_4]))
+
+        hub = RedisMessageQueue(replay_size=3)
+        subscription = MessageQueue.subscribe(
+            hub, 1, DB_NAME, {'thread-1': None}
+        )
+        hub.dispatch({
+            'type': 'message',
+            'channel': 'chat:room:%s:thread-1' % DB_NAME,
+            'data': 'message 1-0 {"type": "message"}',
+        })
+        self.assertEqual(subscription.get().id, '1-0')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            ids = [
+                hub.publish(1, {'type': 'message', 'id': 0}),
+                hub.publish_room('thread-1', {'type': 'message', 'id': 1}),
+                hub.publish(1, {'type': 'message', 'id': 2}),
+                hub.publish_room('thread-1', {'type': 'message', 'id': 3}),
+            ]
+        self.assertEqual(
+            [
+                delivery.id for delivery in hub.replay(
+                    1, DB_NAME, ids[1], subscription.rooms
+                )
+            ],
+            ids[2:]
+        )
+        self.assertEqual(hub.replay(1, DB_NAME, ids[1]), None)
+
+        # The stream of the room holds a full window of events newer than
+        # the last one, which may have been trimmed
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            last_event_id = hub.publish(2, {'type': 'message'})
+            for index in range(2):
+                hub.publish_room('thread-2', {'type': 'message'})
+        self.assertEqual(
+            len(hub.replay(2, DB_NAME, last_event_id, ['thread-2'])), 2
+        )
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            hub.publish_room('thread-2', {'type': 'message'})
+        self.assertEqual(
+            hub.replay(2, DB_NAME, last_event_id, ['thread-2']), None
+        )
+
 
 def _suite():
     "Test suite"